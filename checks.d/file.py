@@ -1,9 +1,20 @@
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.insert(1, agent_lib_dir)
+
 import errno
+import fnmatch
 import glob
-import os
 import time
 
+from scandir import scandir
+
 from checks import AgentCheck
+from config import _is_affirmative
+from helpers import compile_regex
+import inotify
 
 class FileCheck(AgentCheck):
 
@@ -11,33 +22,154 @@ class FileCheck(AgentCheck):
     STATUS_ABSENT = 'absent'
     STATUS_PRESENT = 'present'
 
+    # Anything that changes which files are in a watched directory, or their ctimes, or
+    # means the directory isn't at the path we're watching any more.
+    WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+                  inotify.IN_ATTRIB | inotify.IN_MODIFY | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+                  inotify.IN_ONLYDIR)
+
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self._last_state_by_path = {}
+        # For instances using inotify: the Inotify (False if it isn't available), the watch
+        # descriptor of each watched directory and vice versa, how many times each directory
+        # has changed, and the last scan_files result for each (path, max_files) along with
+        # how many times its directory had changed at the time.
+        self._inotify = None
+        self._watches = {}
+        self._watched = {}
+        self._generations = {}
+        self._scans = {}
 
     def has_different_status(self, path, current):
         last_state = self._last_state_by_path.get(path, None)
         self._last_state_by_path[path] = current
         return (last_state is not None and last_state != current)
 
-    def stat_file(self, path):
+    def iglob(self, path):
+        """
+        Like glob.iglob, but when only the last part of `path` has wildcards in it, the
+        directory is read an entry at a time rather than listed in full up front.
+        """
+        dirname, pattern = os.path.split(path)
+        if not glob.has_magic(pattern) or glob.has_magic(dirname):
+            for filename in glob.iglob(path):
+                yield filename
+            return
+
+        regex = compile_regex(fnmatch.translate(pattern))
         try:
-            files = glob.glob(path)
-            if len(files) > 0:
-                if len(files) > self.MAX_FILES_TO_STAT:
-                    raise Exception("File check sanity check prevents more than %d files" % (self.MAX_FILES_TO_STAT))
-                # Stat each file and return the oldest file, as it's ctime will be the first in our ascending list.
-                sorted_files = sorted(files, cmp=lambda x, y: cmp(os.stat(x).st_ctime, os.stat(y).st_ctime))
-                statinfo = os.stat(sorted_files[0])
-                return self.STATUS_PRESENT, statinfo
-            else:
-                return self.STATUS_ABSENT, []
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                return self.STATUS_ABSENT, []
-            else:
+            entries = scandir(dirname or os.curdir)
+        except OSError:
+            # glob doesn't match anything in directories it can't list either
+            return
+
+        for entry in entries:
+            # glob leaves out hidden files unless the pattern asks for them
+            if entry.name[0] == '.' and pattern[0] != '.':
+                continue
+            if regex.match(entry.name):
+                yield os.path.join(dirname, entry.name)
+
+    def scan_files(self, path, max_files):
+        """
+        Returns the number of files matching `path`, with the stat results of the oldest
+        and newest of them (by ctime), stat'ing each file once. Gives up as soon as more
+        than `max_files` match.
+        """
+        matched = 0
+        count = 0
+        oldest = newest = None
+        for filename in self.iglob(path):
+            matched += 1
+            if matched > max_files:
+                raise Exception("File check sanity check prevents more than %d files" % (max_files))
+
+            try:
+                statinfo = os.stat(filename)
+            except OSError, e:
+                # Removed since we globbed it; the rest may still be there.
+                if e.errno == errno.ENOENT:
+                    continue
                 raise
 
+            count += 1
+            if oldest is None or statinfo.st_ctime < oldest.st_ctime:
+                oldest = statinfo
+            if newest is None or statinfo.st_ctime > newest.st_ctime:
+                newest = statinfo
+
+        return count, oldest, newest
+
+    def stat_file(self, path, max_files=MAX_FILES_TO_STAT):
+        """Returns whether any files match `path`, with the stat results of the oldest"""
+        count, oldest, newest = self.scan_files(path, max_files)
+        if count > 0:
+            return self.STATUS_PRESENT, oldest
+        else:
+            return self.STATUS_ABSENT, []
+
+    def watcher(self):
+        """Returns the Inotify, or None if inotify isn't available here"""
+        if self._inotify is None:
+            try:
+                self._inotify = inotify.Inotify()
+            except OSError, e:
+                self.log.warning("inotify isn't available, so file checks will glob every run: %s" % e)
+                self._inotify = False
+        return self._inotify or None
+
+    def process_events(self):
+        """Notes which watched directories have changed since the last run"""
+        for wd, mask, cookie, name in self._inotify.read_events():
+            if mask & inotify.IN_Q_OVERFLOW:
+                # Events were lost, so every path has to be looked at again.
+                self._scans.clear()
+                continue
+
+            for dirname in self._watched.get(wd, ()):
+                self._generations[dirname] += 1
+
+            if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED):
+                # The directory's gone or been replaced: watch whatever is there next time.
+                self.unwatch(wd)
+
+    def unwatch(self, wd):
+        for dirname in self._watched.pop(wd, ()):
+            del self._watches[dirname]
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            # Already removed along with the directory.
+            pass
+
+    def cached_scan(self, path, max_files):
+        """
+        scan_files, reusing the last result for paths in directories we're watching that
+        haven't changed since. Paths in directories that can't be watched (with wildcards
+        in them, or that don't exist) are scanned every time.
+        """
+        dirname = os.path.dirname(path)
+        if glob.has_magic(dirname):
+            return self.scan_files(path, max_files)
+
+        if dirname not in self._watches:
+            try:
+                wd = self._inotify.add_watch(dirname or os.curdir, self.WATCH_MASK)
+            except OSError:
+                return self.scan_files(path, max_files)
+            self._watches[dirname] = wd
+            self._watched.setdefault(wd, set()).add(dirname)
+            # Whatever happened while it wasn't watched needs looking at.
+            self._generations[dirname] = self._generations.get(dirname, 0) + 1
+
+        generation = self._generations[dirname]
+        scan = self._scans.get((path, max_files))
+        if scan is None or scan[0] != generation:
+            scan = (generation, self.scan_files(path, max_files))
+            self._scans[(path, max_files)] = scan
+        return scan[1]
+
     def check(self, instance):
         """
         Stats a file and emits service_checks and metrics on file creation/age.
@@ -49,8 +181,16 @@ class FileCheck(AgentCheck):
 
         path = instance['path']
         expect = instance['expect']
+        max_files = int(instance.get('max_files', self.MAX_FILES_TO_STAT))
+        aggregate = _is_affirmative(instance.get('aggregate', False))
+        watch = _is_affirmative(instance.get('inotify', self.init_config.get('inotify', False)))
 
-        status, statinfo = self.stat_file(path)
+        if watch and self.watcher():
+            self.process_events()
+            count, statinfo, newest = self.cached_scan(path, max_files)
+        else:
+            count, statinfo, newest = self.scan_files(path, max_files)
+        status = self.STATUS_PRESENT if count > 0 else self.STATUS_ABSENT
 
         tags = [
             'expected_status:' + expect,
@@ -90,3 +230,11 @@ class FileCheck(AgentCheck):
         if status == self.STATUS_PRESENT:
             file_age = time.time() - statinfo.st_ctime
         self.gauge('file.age_seconds', file_age, tags=tags)
+
+        # And, for directories full of files, how many there are and how new the newest is:
+        if aggregate:
+            newest_age = -1
+            if status == self.STATUS_PRESENT:
+                newest_age = time.time() - newest.st_ctime
+            self.gauge('file.count', count, tags=tags)
+            self.gauge('file.newest_age_seconds', newest_age, tags=tags)
@@ -1,5 +1,10 @@
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.insert(1, agent_lib_dir)
+
 # stdlib
-import re
 import time
 from urlparse import urljoin
 
@@ -8,6 +13,7 @@ import requests
 
 # project
 from checks import AgentCheck
+from helpers import compile_regex
 
 class NSQ(AgentCheck):
 
@@ -75,7 +81,7 @@ class NSQ(AgentCheck):
             topic_name_pattern = None
             topic_name_regex = self.init_config.get('topic_name_regex')
             if topic_name_regex:
-                topic_name_pattern = re.compile(topic_name_regex)
+                topic_name_pattern = compile_regex(topic_name_regex)
 
             # Descend in to topic
             for topic in response['data']['topics']:
@@ -6,19 +6,124 @@ sys.path.insert(1, agent_lib_dir)
 
 import re
 import errno
+import json
+from glob import glob
 
 from checks import AgentCheck
-from helpers import reverse_readline
+from helpers import compile_regex, line_prefilter, regex_literal
+import kernel_log
+
+class OOMCounter(object):
+    """
+    Counts OOM kills since the last reboot in the kernel log lines handed to it by a
+    kernel_log.KernelLogScanner: first reading backwards until it finds a reboot,
+    then carrying on with the lines appended to the log since.
+    """
+
+    # reboots are told apart by the uptime going backwards, which the scanner
+    # hands over even between lines the prefilter rules out
+    uptimes = True
+
+    def __init__(self, killedRE, prefilter):
+        self.killedRE = killedRE
+        self.prefilter = prefilter
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        # groupdict of the most recent kill message
+        self.last_killed = None
+        # the most recent uptime seen, and the oldest one seen since the last boot
+        self.uptime = None
+        self.oldest_uptime = None
+        # whether the last boot is in the lines we've been handed
+        self.rebooted = False
+
+    def consume_backward(self, fields, candidate):
+        if 'uptime' in fields:
+            uptime = float(fields['uptime'])
+
+            # only process lines since the last reboot -- we're processing backwards,
+            # so if we see an uptime larger than the last one we saw, it indicates
+            # a reboot (the current line is the lowest uptime in the current sequence)
+            #
+            # this is not entirely optimal for a filtered kernel log: it won't abort on
+            # equal timestamps, such as multiple reboot messages with timestamp 0, even
+            # though we would otherwise want to. if you filter your target log that heavily,
+            # though, it shouldn't be a problem -- and the complexity of capturing this case
+            # plus a full count of OOMs is not really worth the optimization
+            if self.oldest_uptime != None and uptime > self.oldest_uptime:
+                self.rebooted = True
+                return True
+
+            self.oldest_uptime = uptime
+            if self.uptime == None:
+                self.uptime = uptime
+
+        if not candidate:
+            return False
+
+        killed_match = self.killedRE.match(fields['message'])
+        if killed_match:
+            self.count += 1
+            self.last_killed = self.last_killed or killed_match.groupdict()
+
+        return False
+
+    def consume(self, records):
+        for fields in records:
+            if 'uptime' in fields:
+                uptime = float(fields['uptime'])
+
+                # the mirror image of the backwards scan: going forwards, an uptime
+                # smaller than the previous one means the machine rebooted, so
+                # everything counted so far happened before the current boot
+                if self.uptime != None and uptime < self.uptime:
+                    self.count = 0
+                    self.last_killed = None
+                    self.oldest_uptime = uptime
+                    self.rebooted = True
+
+                self.uptime = uptime
+                if self.oldest_uptime == None:
+                    self.oldest_uptime = uptime
+
+            # just an uptime, from a line the prefilter ruled out
+            if 'message' not in fields:
+                continue
+
+            killed_match = self.killedRE.match(fields['message'])
+            if killed_match:
+                self.count += 1
+                self.last_killed = killed_match.groupdict()
 
 class OOM(AgentCheck):
-    def check(self, instance):
-        kernlogRE = re.compile(instance.get('kernel_line_regex'))
-        killedRE = re.compile(instance.get('kill_message_regex'), re.IGNORECASE)
+    # logged by the kernel as it boots; see `prefilter`
+    BOOT_MESSAGE = 'Linux version'
 
-        last = None
+    def check(self, instance):
+        kernlogRE = compile_regex(instance.get('kernel_line_regex'))
+        killedRE = compile_regex(instance.get('kill_message_regex'), re.IGNORECASE)
+        logfile = instance.get('logfile')
+        prefilter_substrings = instance.get('prefilter_substrings')
+        if prefilter_substrings is not None:
+            prefilter_substrings = tuple(prefilter_substrings)
+
+        # how long each run may spend reading the log, and how much of it; any
+        # reading left over is picked up on the next run
+        budget = kernel_log.Budget(instance.get('max_scan_seconds'), instance.get('max_scan_bytes'))
+
+        # the log is read through a scanner shared with any other check reading the same
+        # file with the same regex, which remembers where it got to between runs so only
+        # appended lines get parsed (rotated or truncated logs are read backwards again)
+        scanner = kernel_log.scanner(logfile, kernlogRE)
+        counter = scanner.consumer(
+            ('oom', killedRE.pattern, prefilter_substrings),
+            lambda: OOMCounter(killedRE, self.prefilter(prefilter_substrings, killedRE))
+        )
 
         try:
-            fh = open(instance.get('logfile'), 'rt')
+            scanner.scan(budget)
         except IOError, err:
             if err.errno == errno.ENOENT:
                 level = AgentCheck.WARNING
@@ -26,50 +131,117 @@ class OOM(AgentCheck):
                 level = AgentCheck.CRITICAL
 
             self.service_check('system.oom', level, message=str(err))
+            return
+
+        count = counter.count
+        last_killed = counter.last_killed
+        truncated = scanner.truncated
+
+        # the last boot may be further back than the start of the log, in which case the
+        # kills since are carried on counting in the rotated logs
+        rotated_logfiles = instance.get('rotated_logfiles')
+        if rotated_logfiles and not counter.rebooted and not truncated:
+            index = kernel_log.index(
+                instance.get('rotated_index'),
+                json.dumps([kernlogRE.pattern, killedRE.pattern, prefilter_substrings])
+            )
+            # rotated logs are read whole or not at all, so one is only started within budget
+            summarize = lambda path: None if budget.exceeded else self.summarize(path, kernlogRE, killedRE, prefilter_substrings, budget)
+
+            rotated_count, rotated_killed, truncated = self.count_rotated(
+                logfile, rotated_logfiles, index, counter.oldest_uptime, summarize
+            )
+            count += rotated_count
+            last_killed = last_killed or rotated_killed
+
+        tags = ['scan_truncated:true'] if truncated else []
+        self.gauge('system.oom.count', count, tags=tags)
+        self.gauge('system.oom.lines_scanned', scanner.lines_scanned)
+        self.gauge('system.oom.lines_regex_matched', scanner.lines_regex_matched)
+        self.gauge('system.oom.scan_bytes', budget.bytes)
+        self.gauge('system.oom.scan_duration', budget.duration())
+
+        if last_killed == None:
+            self.service_check('system.oom', AgentCheck.OK)
         else:
-            last_killed = None
-            count = 0
-
-            with fh:
-                for line in reverse_readline(fh):
-                    result = kernlogRE.match(line)
-
-                    if not result:
-                        continue
-
-                    results = result.groupdict()
-
-                    message = results['message']
-
-                    if 'uptime' in results:
-                        uptime = float(results['uptime'])
-
-                        # only process lines since the last reboot -- we're processing backwards,
-                        # so if we see an uptime larger than the last one we saw, it indicates
-                        # a reboot (the current line is the lowest uptime in the current sequence)
-                        #
-                        # this is not entirely optimal for a filtered kernel log: it won't abort on
-                        # equal timestamps, such as multiple reboot messages with timestamp 0, even
-                        # though we would otherwise want to. if you filter your target log that heavily,
-                        # though, it shouldn't be a problem -- and the complexity of capturing this case
-                        # plus a full count of OOMs is not really worth the optimization
-                        if last != None and uptime > last:
-                            break
-
-                        last = uptime
-
-                    killed_match = killedRE.match(message)
-                    if not killed_match:
-                        continue
-
-                    count += 1
-                    last_killed = last_killed or killed_match
-
-            self.gauge('system.oom.count', count)
-
-            if last_killed == None:
-                self.service_check('system.oom', AgentCheck.OK)
-            else:
-                self.service_check('system.oom', AgentCheck.CRITICAL,
-                    message="Process OOM killed since last boot: %s" % last_killed.groupdict()
+            self.service_check('system.oom', AgentCheck.CRITICAL,
+                message="Process OOM killed since last boot: %s" % last_killed
+            )
+
+    def count_rotated(self, logfile, pattern, index, oldest_uptime, summarize):
+        """
+        Returns the number of kills in the rotated logs matching the glob `pattern`, newest
+        first, up to the reboot, along with the most recent kill's groupdict and whether
+        `summarize` put off reading any of them
+        """
+        rotated = [path for path in glob(pattern) if path not in (logfile, index.path)]
+        try:
+            rotated.sort(key=lambda path: os.stat(path).st_mtime, reverse=True)
+        except OSError, err:
+            # rotated while we were looking; the next run will do
+            self.warning("Couldn't list rotated logs: %s" % err)
+            return 0, None, False
+
+        count = 0
+        last_killed = None
+        truncated = False
+        for path in rotated:
+            try:
+                summary = index.summary(path, summarize)
+            except (IOError, OSError), err:
+                self.warning("Couldn't read rotated log %s: %s" % (path, err))
+                break
+
+            if summary == None:
+                truncated = True
+                break
+
+            # a newer log starting with a smaller uptime than this one ends with
+            # means the machine rebooted in between
+            if oldest_uptime != None and summary['max_uptime'] != None and summary['max_uptime'] > oldest_uptime:
+                break
+
+            count += summary['count']
+            if last_killed == None and summary['last_killed'] != None:
+                # summaries loaded from the index are unicode, which would show up in the message
+                last_killed = dict(
+                    (str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+                    for key, value in summary['last_killed'].iteritems()
                 )
+            if summary['min_uptime'] != None:
+                oldest_uptime = summary['min_uptime']
+
+            if summary['rebooted']:
+                break
+
+        index.prune(rotated)
+        return count, last_killed, truncated
+
+    def summarize(self, path, kernlogRE, killedRE, prefilter_substrings, budget):
+        """Reads the whole of a rotated log, and summarizes the kills since its last boot"""
+        counter = OOMCounter(killedRE, self.prefilter(prefilter_substrings, killedRE))
+        kernel_log.read_forward(path, kernlogRE, counter, budget)
+
+        return {
+            'min_uptime': counter.oldest_uptime,
+            'max_uptime': counter.uptime,
+            'count': counter.count,
+            'last_killed': counter.last_killed,
+            'rebooted': counter.rebooted,
+        }
+
+    def prefilter(self, substrings, killedRE):
+        """
+        Returns a function ruling out lines that can't matter before any regex runs on them:
+        either those containing none of `prefilter_substrings`, or by default those that look
+        like neither a kill message nor the kernel booting. Reboots are noticed either way,
+        from the uptimes the scanner reads out of the lines ruled out.
+        """
+        if substrings is not None:
+            return line_prefilter(substrings)
+
+        literal = regex_literal(killedRE.pattern)
+        if literal is None:
+            return line_prefilter([])
+
+        return line_prefilter([literal, self.BOOT_MESSAGE], ignorecase=killedRE.flags & re.IGNORECASE)
@@ -7,9 +7,10 @@ sys.path.insert(1, agent_lib_dir)
 import re
 
 from checks import AgentCheck
-from collections import defaultdict
-from helpers import reverse_readline, parse_fix_timestamp
+from collections import defaultdict, deque
+from helpers import chunked_reverse_readline, compile_regex, line_prefilter, parse_fix_timestamp, regex_literal
 from datetime import datetime, timedelta
+import kernel_log
 
 def regex_matches(line, regex):
     if not line or not regex:
@@ -22,6 +23,106 @@ def regex_matches(line, regex):
 
     return result.groupdict()
 
+def parse_fields(kern_results, process_name_regex, timestamp_format, dt_now):
+    """
+    Returns a (timestamp, is_segfault, process_name) tuple for the groupdict of a line
+    that matched kernel_line_regex, or None if it can't be parsed.
+    """
+    message = kern_results.get('message', None)
+    timestamp = kern_results.get('timestamp', None)
+
+    try:
+        dt_timestamp = parse_fix_timestamp(timestamp, timestamp_format, dt_now)
+    except (ValueError, TypeError):
+        dt_timestamp = None
+
+    if message == None or dt_timestamp == None:
+        return None
+
+    # process name regex is an extra regex to extract the process name
+    # from the 'message' capturing group. behaves the same as kernel_line_regex
+    # in that a failed match = skip this line. if unspecified, do not extract
+    # a process name
+    process_name = None
+    if process_name_regex:
+        pname_results = regex_matches(message, process_name_regex)
+        if not pname_results:
+            return dt_timestamp, False, None
+
+        process_name = pname_results.get('process', None)
+
+    return dt_timestamp, True, process_name
+
+class SegfaultWindows(object):
+    """
+    Keeps the timestamps of the segfaults inside the time window by process name
+    (oldest first), from the kernel log lines handed to it by a
+    kernel_log.KernelLogScanner. This is what `tail` mode uses between runs.
+
+    It outlives the check instance that made it (the scanner is shared by the whole
+    process), so it holds on to no check: lines it couldn't parse are counted in
+    `parse_errors` for whichever check runs next to report.
+    """
+
+    def __init__(self, process_name_regex, timestamp_format, time_window_seconds, prefilter):
+        self.process_name_regex = process_name_regex
+        self.timestamp_format = timestamp_format
+        self.time_window_seconds = time_window_seconds
+        self.prefilter = prefilter
+        self.mock_now = None
+        self.parse_errors = 0
+        self.reset()
+
+    def now(self):
+        return self.mock_now or datetime.now()
+
+    def reset(self):
+        self.windows = {}
+        self.dt_now = self.now()
+        self.dt_oldest = self.dt_now - timedelta(seconds=self.time_window_seconds)
+
+    def parse(self, fields, dt_now):
+        parsed = parse_fields(fields, self.process_name_regex, self.timestamp_format, dt_now)
+        if parsed is None:
+            self.parse_errors += 1
+        return parsed
+
+    def consume_backward(self, fields, candidate):
+        parsed = self.parse(fields, self.dt_now)
+        if parsed is None:
+            return False
+
+        dt_timestamp, is_segfault, process_name = parsed
+
+        if dt_timestamp < self.dt_oldest:
+            return True
+
+        if is_segfault and candidate:
+            self.windows.setdefault(process_name, deque()).appendleft(dt_timestamp)
+
+        return False
+
+    def consume(self, records):
+        dt_now = self.now()
+        for fields in records:
+            parsed = self.parse(fields, dt_now)
+            if parsed is None:
+                continue
+
+            dt_timestamp, is_segfault, process_name = parsed
+
+            if is_segfault:
+                self.windows.setdefault(process_name, deque()).append(dt_timestamp)
+
+    def evict(self, dt_oldest):
+        """Drops the segfaults that have slid out of the time window"""
+        for pname in self.windows.keys():
+            timestamps = self.windows[pname]
+            while timestamps and timestamps[0] < dt_oldest:
+                timestamps.popleft()
+            if not timestamps:
+                del self.windows[pname]
+
 class Segfault(AgentCheck):
     def tags(self, *tags):
         return self.instance_tags + list(tags)
@@ -32,12 +133,12 @@ class Segfault(AgentCheck):
 
         try:
             # the regex to parse the kernel log line with
-            kernel_line_regex = re.compile(instance['kernel_line_regex'])
+            kernel_line_regex = compile_regex(instance['kernel_line_regex'])
 
             # the regex to extract the process name from the message with
             process_name_regex = None
             if 'process_name_regex' in instance and instance['process_name_regex']:
-                process_name_regex = re.compile(instance['process_name_regex'])
+                process_name_regex = compile_regex(instance['process_name_regex'])
 
             # the format to parse the timestamp from
             # %b %d %H:%M:%S
@@ -48,6 +149,21 @@ class Segfault(AgentCheck):
 
             # the logfile to read from
             logfile_path = instance['logfile']
+
+            # substrings a line has to contain one of to be parsed at all, by
+            # default the longest literal in process_name_regex
+            prefilter_substrings = instance.get('prefilter_substrings')
+            if prefilter_substrings is not None:
+                prefilter_substrings = tuple(prefilter_substrings)
+                prefilter = line_prefilter(prefilter_substrings)
+            elif process_name_regex:
+                prefilter = line_prefilter(filter(None, [regex_literal(process_name_regex.pattern)]),
+                                           ignorecase=process_name_regex.flags & re.IGNORECASE)
+            else:
+                prefilter = line_prefilter([])
+
+            # how long each run may spend reading the log, and how much of it
+            budget = kernel_log.Budget(instance.get('max_scan_seconds'), instance.get('max_scan_bytes'))
         except KeyError, e:
             self.increment('system.segfault.errors', tags=self.tags('type:config'))
             print >> sys.stderr, "Instance config: Key `%s` is required" % e.args[0]
@@ -57,56 +173,60 @@ class Segfault(AgentCheck):
             print >> sys.stderr, "Error loading config: %s" % e
             return
 
-        try:
-            fh = open(logfile_path, 'rt')
-        except IOError, err:
-            self.increment('system.segfault.errors', tags=self.tags('type:io'))
-            return
-
-        counts = defaultdict(lambda: 0)
         dt_now = self.mock_now or datetime.now()
         dt_oldest = dt_now - timedelta(seconds=time_window_seconds)
 
-        with fh:
-            for line in reverse_readline(fh):
-                kern_results = regex_matches(line, kernel_line_regex)
+        if instance.get('tail', False):
+            # keep reading the logfile where we left off between runs, rather than
+            # scanning the whole time window backwards every time. the scanner is
+            # shared with any other check reading the same file with the same regex
+            scanner = kernel_log.scanner(logfile_path, kernel_line_regex)
+            segfaults = scanner.consumer(
+                ('segfault', instance.get('process_name_regex'), timestamp_format, time_window_seconds,
+                 prefilter_substrings, tuple(self.instance_tags)),
+                lambda: SegfaultWindows(process_name_regex, timestamp_format, time_window_seconds, prefilter)
+            )
+            segfaults.mock_now = self.mock_now
 
-                # no match = skip this line
-                if not kern_results:
-                    continue
+            try:
+                scanner.scan(budget)
+            except IOError, err:
+                self.increment('system.segfault.errors', tags=self.tags('type:io'))
+                return
+            finally:
+                # including those parsed by scans other checks ran since our last run
+                if segfaults.parse_errors:
+                    self.increment('system.segfault.errors', segfaults.parse_errors, tags=self.tags('type:parse'))
+                    segfaults.parse_errors = 0
 
-                message = kern_results.get('message', None)
-                timestamp = kern_results.get('timestamp', None)
+            segfaults.evict(dt_oldest)
+            windows = segfaults.windows
+            truncated = scanner.truncated
+            self.lines_scanned = scanner.lines_scanned
+            self.lines_regex_matched = scanner.lines_regex_matched
+        else:
+            try:
+                fh = open(logfile_path, 'rt')
+            except IOError, err:
+                self.increment('system.segfault.errors', tags=self.tags('type:io'))
+                return
 
-                try:
-                    dt_timestamp = parse_fix_timestamp(timestamp, timestamp_format, dt_now)
-                except (ValueError, TypeError):
-                    dt_timestamp = None
+            self.lines_scanned = 0
+            self.lines_regex_matched = 0
 
-                if message == None or dt_timestamp == None:
-                    self.increment('system.segfault.errors', tags=self.tags('type:parse'))
-                    continue
+            with fh:
+                windows = self.scan_backward(fh, prefilter, budget, kernel_line_regex, process_name_regex, timestamp_format, dt_now, dt_oldest)
+            truncated = budget.exceeded
 
-                if dt_timestamp < dt_oldest:
-                    # we only look back X seconds; we can end early if we hit a timestamp earlier than that
-                    break
+        self.gauge('system.segfault.lines_scanned', self.lines_scanned, tags=self.tags())
+        self.gauge('system.segfault.lines_regex_matched', self.lines_regex_matched, tags=self.tags())
+        self.gauge('system.segfault.scan_bytes', budget.bytes, tags=self.tags())
+        self.gauge('system.segfault.scan_duration', budget.duration(), tags=self.tags())
 
-                # process name regex is an extra regex to extract the process name
-                # from the 'message' capturing group. behaves the same as kernel_line_regex
-                # in that a failed match = skip this line. if unspecified, do not extract
-                # a process name
-                process_name = None
-                if process_name_regex:
-                    pname_results = regex_matches(message, process_name_regex)
-                    if not pname_results:
-                        continue
-
-                    process_name = pname_results.get('process', None)
-
-                counts[process_name] += 1
-
-        for pname, num_segfaults in counts.iteritems():
+        for pname, timestamps in windows.iteritems():
             tags = ['time_window:%s' % time_window_seconds]
+            if truncated:
+                tags.append('scan_truncated:true')
             # sometimes the process name isn't present / can't be extracted
             # we might want to put the process name in the tag config, so don't
             # add on an extra 'process' tag that's empty in addition
@@ -114,4 +234,58 @@ class Segfault(AgentCheck):
                 tags.append('process:%s' % pname)
 
             metric_tags = self.tags(*tags)
-            self.gauge('system.segfault.count', num_segfaults, tags=metric_tags)
+            self.gauge('system.segfault.count', len(timestamps), tags=metric_tags)
+
+    def parse_line(self, line, kernel_line_regex, process_name_regex, timestamp_format, dt_now):
+        """
+        Returns a (timestamp, is_segfault, process_name) tuple for a kernel log line, or
+        None if the line should be skipped altogether.
+        """
+        kern_results = regex_matches(line, kernel_line_regex)
+
+        # no match = skip this line
+        if not kern_results:
+            return None
+
+        parsed = parse_fields(kern_results, process_name_regex, timestamp_format, dt_now)
+        if parsed is None:
+            self.increment('system.segfault.errors', tags=self.tags('type:parse'))
+        return parsed
+
+    def scan_backward(self, fh, prefilter, budget, kernel_line_regex, process_name_regex, timestamp_format, dt_now, dt_oldest):
+        """
+        Collects segfault timestamps newer than `dt_oldest` by reading the log backwards,
+        stopping early if `budget` runs out
+        """
+        windows = defaultdict(deque)
+        skipped = 0
+
+        for line in chunked_reverse_readline(fh):
+            if budget.exceeded:
+                break
+
+            budget.spend(len(line) + 1)
+            self.lines_scanned += 1
+            candidate = prefilter(line)
+            if not candidate:
+                # these can't be segfaults, but parse one every so often to notice
+                # when we're past the start of the time window
+                skipped += 1
+                if skipped % kernel_log.SAMPLE_LINES:
+                    continue
+
+            self.lines_regex_matched += 1
+            parsed = self.parse_line(line, kernel_line_regex, process_name_regex, timestamp_format, dt_now)
+            if parsed is None:
+                continue
+
+            dt_timestamp, is_segfault, process_name = parsed
+
+            if dt_timestamp < dt_oldest:
+                # we only look back X seconds; we can end early if we hit a timestamp earlier than that
+                break
+
+            if is_segfault and candidate:
+                windows[process_name].appendleft(dt_timestamp)
+
+        return dict(windows)
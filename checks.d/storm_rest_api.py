@@ -8,6 +8,7 @@ sys.path.insert(1, agent_lib_dir)
 from collections import namedtuple
 import urlparse
 import json
+import operator
 import time
 import sys
 
@@ -17,7 +18,7 @@ import requests
 # project
 from checks import AgentCheck
 from util import headers
-import re
+from helpers import compile_regex
 import storm_utils
 
 
@@ -35,9 +36,23 @@ StormConfig = namedtuple(
         'cache_file',
         'cache_staleness',
         'task_id_cleaner_regex',
+        'executor_metrics',
     ]
 )
 
+class MetricNames(dict):
+    """Full metric names by their short name, for one metric prefix, each made once"""
+    def __init__(self, metric_prefix):
+        dict.__init__(self)
+        if metric_prefix is not None:
+            self.template = metric_prefix + '.storm.rest.%s'
+        else:
+            self.template = 'storm.rest.%s'
+
+    def __missing__(self, name):
+        metric = self[name] = self.template % name
+        return metric
+
 class StormRESTCheck(AgentCheck):
     class ConnectionFailure(StandardError):
         def __init__(self, url, timeout):
@@ -47,6 +62,25 @@ class StormRESTCheck(AgentCheck):
     DEFAULT_TIMEOUT = 5 # seconds
     DEFAULT_STALENESS=240 # seconds
 
+    TASK_COUNTERS = ['emitted', 'transferred', 'acked', 'failed']
+    EXECUTOR_COUNTERS = ['emitted', 'transferred', 'acked', 'executed', 'failed']
+    # metric, stat, multiplier
+    EXECUTOR_GAUGES = [
+        ('execute_latency_us', 'executeLatency', 1),
+        ('process_latency_us', 'processLatency', 1),
+        ('capacity_percent', 'capacity', 100),
+    ]
+    EXECUTOR_METRICS = ['raw', 'host', 'both']
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self._cache_readers = {}
+        self._metric_names = {}
+        self._component_tags = {}
+        self._host_tags = {}
+        # (cache file, topology, component) -> executor id -> its counters at the last run
+        self._executor_counts = {}
+
     def instance_config(self, instance):
         url = instance.get('url')
         if url is None:
@@ -58,7 +92,7 @@ class StormRESTCheck(AgentCheck):
 
         timeout = instance.get('timeout', self.DEFAULT_TIMEOUT)
         topology_timeout = instance.get('topology_timeout', timeout)
-        topologies_re = re.compile(instance.get('topologies', '(.*)'))
+        topologies_re = compile_regex(instance.get('topologies', '(.*)'))
 
         task_tags_from_json = {}
         tag_file = instance.get('task_tags_file', None)
@@ -68,8 +102,16 @@ class StormRESTCheck(AgentCheck):
         task_tags = instance.get('task_tags', {}).copy()
         task_tags.update(task_tags_from_json)
 
+        task_id_cleaner_regex = instance.get('task_id_cleaner_regex', None)
+        if task_id_cleaner_regex is not None:
+            task_id_cleaner_regex = compile_regex(task_id_cleaner_regex)
+
+        executor_metrics = instance.get('executor_metrics', 'raw')
+        if executor_metrics not in self.EXECUTOR_METRICS:
+            raise Exception("executor_metrics must be one of %s" % ', '.join(self.EXECUTOR_METRICS))
+
         raw_whitelist = set(instance.get('executor_details_whitelist', []))
-        executor_details_whitelist = [re.compile(regex) for regex in raw_whitelist]
+        executor_details_whitelist = [compile_regex(regex) for regex in raw_whitelist]
 
         return StormConfig(
             metric_prefix=instance.get('metric_prefix', None),
@@ -82,17 +124,24 @@ class StormRESTCheck(AgentCheck):
             cache_file=cache_file,
             cache_staleness=instance.get('cache_staleness', self.DEFAULT_STALENESS),
             topologies=topologies_re,
-            task_id_cleaner_regex=instance.get('task_id_cleaner_regex', None),
+            task_id_cleaner_regex=task_id_cleaner_regex,
+            executor_metrics=executor_metrics,
         )
 
+    def metric_names(self, config):
+        names = self._metric_names.get(config.metric_prefix)
+        if names is None:
+            names = self._metric_names[config.metric_prefix] = MetricNames(config.metric_prefix)
+        return names
+
     def metric(self, config, name):
-        if config.metric_prefix is not None:
-            return "%s.storm.rest.%s" % (config.metric_prefix, name)
-        else:
-            return "storm.rest.%s" % name
+        return self.metric_names(config)[name]
 
     def check(self, instance):
         config = self.instance_config(instance)
+        # The tags and task tags can change between runs
+        self._component_tags = {}
+        self._host_tags = {}
 
         check_status = AgentCheck.OK
         check_msg = 'Everything went well'
@@ -100,20 +149,20 @@ class StormRESTCheck(AgentCheck):
             'url:' + config.url,
         ] + config.tags
 
-        details = None
-        with open(config.cache_file, 'r') as cache_f:
-            details = json.load(cache_f)
+        reader = self._cache_readers.get(config.cache_file)
+        if reader is None:
+            reader = self._cache_readers[config.cache_file] = storm_utils.CacheReader(config.cache_file)
+        details = reader.read()
 
-        oldest_acceptable_cache_time = time.time() - config.cache_staleness
+        now = time.time()
+        oldest_acceptable_cache_time = now - config.cache_staleness
         if details['status'] == 'success' and details['updated'] > oldest_acceptable_cache_time:
             data = details['data']
             self.report_cluster(config, data['cluster'])
             self.report_supervisors(config, data['supervisors'])
             self.report_topologies(config, data['topologies'])
             for topology_detail in data['topology_details']:
-                self.report_topology(config, topology_detail['name'], topology_detail['topology'])
-                for executor_details in topology_detail['component_details']:
-                    self.report_executor_details(config, executor_details)
+                self.report_topology_detail(config, topology_detail, details['updated'], now)
         else:
             check_status = AgentCheck.CRITICAL
             if details['status'] != 'success':
@@ -127,6 +176,52 @@ class StormRESTCheck(AgentCheck):
             message=check_msg,
             tags=check_tags)
 
+    def report_topology_detail(self, config, topology_detail, updated, now):
+        """
+        Reports a topology's (and its components') details from the cache, if they're
+        fresh enough, along with how old they are and whether the last attempt to fetch
+        them worked. Caches written before these were tracked separately have the
+        same `updated` time for everything.
+        """
+        name = topology_detail['name']
+        tags = config.tags + [
+            'storm_topology:' + name,
+        ]
+        oldest_acceptable_cache_time = now - config.cache_staleness
+        topology_updated = topology_detail.get('updated', updated)
+        self.gauge(self.metric(config, 'topology.cache_age_seconds'), now - topology_updated, tags=tags)
+
+        stale_components = 0
+        if topology_updated > oldest_acceptable_cache_time:
+            self.report_topology(config, name, topology_detail['topology'])
+            for component in topology_detail['component_details']:
+                # These used to be the details themselves
+                executor_details = component.get('details', component)
+                if component.get('updated', topology_updated) > oldest_acceptable_cache_time and executor_details is not None:
+                    self.report_executor_details(config, executor_details)
+                else:
+                    stale_components += 1
+
+        if topology_updated <= oldest_acceptable_cache_time:
+            check_status = AgentCheck.CRITICAL
+            check_msg = "Cache for topology %s is too stale: %d vs. expected minimum %d" % (name, topology_updated, oldest_acceptable_cache_time)
+        elif topology_detail.get('status', 'success') != 'success':
+            check_status = AgentCheck.WARNING
+            check_msg = "Could not connect to URL %s with timeout %d; reporting details from %d" % (
+                topology_detail['error_url'], topology_detail['error_timeout'], topology_updated)
+        elif stale_components:
+            check_status = AgentCheck.WARNING
+            check_msg = "Cache for %d of topology %s's components is too stale" % (stale_components, name)
+        else:
+            check_status = AgentCheck.OK
+            check_msg = 'Everything went well'
+
+        self.service_check(
+            self.metric(config, 'topology.cached_data_ok'),
+            check_status,
+            message=check_msg,
+            tags=['url:' + config.url] + tags)
+
     def report_cluster(self, config, cluster):
         uptime = cluster.get('nimbusUptime', None)
         if uptime is not None:
@@ -196,109 +291,163 @@ class StormRESTCheck(AgentCheck):
     def task_id_tags(self, config, component_type, task_id):
         cleaner_id = task_id
         if config.task_id_cleaner_regex is not None:
-            match = re.search(config.task_id_cleaner_regex, cleaner_id)
+            match = config.task_id_cleaner_regex.search(cleaner_id)
             if match is not None:
                 cleaner_id = match.group(1)
         return config.task_tags.get(component_type, {}).get(cleaner_id, [])
 
+    def component_tags(self, config, topology_name, component_type, task_id):
+        """
+        The tags for one of a topology's spouts or bolts, shared by everything reported
+        about it (and its executors) in this run
+        """
+        key = (topology_name, component_type, task_id)
+        tags = self._component_tags.get(key)
+        if tags is None:
+            tags = self._component_tags[key] = tuple(
+                config.tags + self.task_id_tags(config, component_type, task_id) + [
+                    'storm_topology:' + topology_name,
+                    'storm_component_type:' + component_type,
+                    'storm_task_id:' + task_id,
+                ])
+        return tags
+
+    def host_tags(self, host, port):
+        """The tags for an executor's host and port, made once per run"""
+        tags = self._host_tags.get((host, port))
+        if tags is None:
+            tags = self._host_tags[host, port] = ('storm_host:' + host, 'storm_port:' + str(port))
+        return tags
+
     def report_topology(self, config, name, details):
         """
         Report statistics for a single topology's spouts and bolts.
         """
-        tags = config.tags + [
-            'storm_topology:' + name,
-        ]
-        def report_task(component_type, name, task, tags):
-            self.gauge(self.metric(config, ('%s.executors_total' % component_type)),
-                       task['executors'], task_tags)
-            self.gauge(self.metric(config, ('%s.tasks_total' % component_type)),
-                       task['tasks'], task_tags)
-
-            self.monotonic_count(self.metric(config, ('%s.emitted_total' % component_type)),
-                       task['emitted'], task_tags)
-            self.monotonic_count(self.metric(config, ('%s.transferred_total' % component_type)),
-                       task['transferred'], task_tags)
-            self.monotonic_count(self.metric(config, ('%s.acked_total' % component_type)),
-                       task['acked'], task_tags)
-            self.monotonic_count(self.metric(config, ('%s.failed_total' % component_type)),
-                       task['failed'], task_tags)
+        names = self.metric_names(config)
+        task_names = {}
+        for component_type in ['spout', 'bolt']:
+            task_names[component_type] = (
+                names[component_type + '.executors_total'],
+                names[component_type + '.tasks_total'],
+                [(key, names['%s.%s_total' % (component_type, key)]) for key in self.TASK_COUNTERS],
+            )
+        def report_task(component_type, task, task_tags):
+            executors_total, tasks_total, counters = task_names[component_type]
+            self.gauge(executors_total, task['executors'], task_tags)
+            self.gauge(tasks_total, task['tasks'], task_tags)
+            for key, metric in counters:
+                self.monotonic_count(metric, task[key], task_tags)
 
         ## Report spouts
         for spout in details.get('spouts'):
-            name = spout['spoutId']
-            task_tags = tags + self.task_id_tags(config, 'spout', name) + [
-                'storm_component_type:spout',
-                'storm_task_id:' + name,
-            ]
-            report_task('spout', name, spout, task_tags)
-            self.gauge(self.metric(config, 'spout.complete_latency_us'),
+            task_tags = self.component_tags(config, name, 'spout', spout['spoutId'])
+            report_task('spout', spout, task_tags)
+            self.gauge(names['spout.complete_latency_us'],
                        float(spout['completeLatency']), task_tags)
 
         for bolt in details.get('bolts'):
-            name = bolt['boltId']
-            task_tags = tags + self.task_id_tags(config, 'bolt', name) + [
-                'storm_component_type:bolt',
-                'storm_task_id:' + name,
-            ]
-            report_task('bolt', name, bolt, task_tags)
+            task_tags = self.component_tags(config, name, 'bolt', bolt['boltId'])
+            report_task('bolt', bolt, task_tags)
             if bolt['executed'] is not None:
                 executed_count = bolt['executed']
             else:
                 executed_count = 0
-            self.monotonic_count(self.metric(config, 'bolt.executed_total'),
+            self.monotonic_count(names['bolt.executed_total'],
                        executed_count, task_tags)
-            self.gauge(self.metric(config, 'bolt.execute_latency_us'),
+            self.gauge(names['bolt.execute_latency_us'],
                        float(bolt['executeLatency']), task_tags)
-            self.gauge(self.metric(config, 'bolt.process_latency_us'),
+            self.gauge(names['bolt.process_latency_us'],
                        float(bolt['processLatency']), task_tags)
-            self.gauge(self.metric(config, 'bolt.capacity_percent'),
+            self.gauge(names['bolt.capacity_percent'],
                        float(bolt['capacity']) * 100, task_tags)
 
     def report_executor_details(self, config, details):
         """
         Report statistics for a single topology's task ID's executors.
         """
-
+        names = self.metric_names(config)
         topology_name = self._topology_name(config, details)
-        name = details['id']
-        task_type = details['componentType']
-        tags = config.tags + self.task_id_tags(config, task_type, name) + [
-            'storm_topology:' + topology_name,
-            'storm_component_type:' + task_type,
-            'storm_task_id:' + details['id'],
-        ]
-        self.gauge(self.metric(config, 'executor.executors_total'),
+        tags = self.component_tags(config, topology_name, details['componentType'], details['id'])
+        self.gauge(names['executor.executors_total'],
                                details['executors'], tags=tags)
-        self.gauge(self.metric(config, 'executor.tasks_total'),
+        self.gauge(names['executor.tasks_total'],
                                details['executors'], tags=tags)
 
+        raw = config.executor_metrics != 'host'
+        by_host = config.executor_metrics != 'raw'
+        counters = [names['executor.%s_total' % key] for key in self.EXECUTOR_COUNTERS]
+        gauges = [names['executor.' + metric] for metric, _, _ in self.EXECUTOR_GAUGES]
+        uptime = names['executor.uptime_seconds']
+
+        # host -> [executors, counter increments, gauge sums, gauge maxima, least uptime]
+        hosts = {}
+        component = (config.cache_file, topology_name, details['id'])
+        last_counts = self._executor_counts.get(component, {})
+        executor_counts = {}
+
         # Embarrassingly, executorStats are undocumented in the REST
         # API docs (so we might not be allowed to rely on them). But
         # they're the only way to get some SERIOUSLY useful metrics -
         # per-host metrics, in particular.
         for executor in details['executorStats']:
-            executor_tags = tags + [
-                'executor_id:' + executor['id'],
-                'storm_host:' + executor['host'],
-                'storm_port:' + str(executor['port']),
-            ]
-            self.monotonic_count(self.metric(config, 'executor.emitted_total'),
-                       executor.get('emitted', 0), tags=executor_tags)
-            self.monotonic_count(self.metric(config, 'executor.transferred_total'),
-                       executor.get('transferred', 0), tags=executor_tags)
-            self.monotonic_count(self.metric(config, 'executor.acked_total'),
-                       executor.get('acked', 0), tags=executor_tags)
-            self.monotonic_count(self.metric(config, 'executor.executed_total'),
-                       executor.get('executed', 0), tags=executor_tags)
-            self.monotonic_count(self.metric(config, 'executor.failed_total'),
-                       executor.get('failed', 0), tags=executor_tags)
-
-            self.gauge(self.metric(config, 'executor.execute_latency_us'),
-                       float(executor.get('executeLatency', 0)), tags=executor_tags)
-            self.gauge(self.metric(config, 'executor.process_latency_us'),
-                       float(executor.get('processLatency', 0)), tags=executor_tags)
-
-            self.gauge(self.metric(config, 'executor.capacity_percent'),
-                       float(executor.get('capacity', 0)) * 100, tags=executor_tags)
-            self.gauge(self.metric(config, 'executor.uptime_seconds'),
-                       storm_utils.translate_timespec(executor.get('uptime', '0s')), tags=executor_tags)
+            counts = [executor.get(key, 0) for key in self.EXECUTOR_COUNTERS]
+            values = [float(executor.get(stat, 0)) * multiplier for _, stat, multiplier in self.EXECUTOR_GAUGES]
+            uptime_seconds = storm_utils.translate_timespec(executor.get('uptime', '0s'))
+
+            if raw:
+                executor_tags = tags + ('executor_id:' + executor['id'],) + self.host_tags(executor['host'], executor['port'])
+                for metric, count in zip(counters, counts):
+                    self.monotonic_count(metric, count, tags=executor_tags)
+                for metric, value in zip(gauges, values):
+                    self.gauge(metric, value, tags=executor_tags)
+                self.gauge(uptime, uptime_seconds, tags=executor_tags)
+
+            if by_host:
+                # How much each counter went up since the last run, wherever the executor
+                # ran then: a counter that went down was reset, so it's all new
+                last = last_counts.get(executor['id'])
+                executor_counts[executor['id']] = counts
+                increments = None
+                if last is not None:
+                    increments = [count - last_count if count >= last_count else count
+                                  for count, last_count in zip(counts, last)]
+
+                host = hosts.get(executor['host'])
+                if host is None:
+                    hosts[executor['host']] = [1, increments, values, list(values), uptime_seconds]
+                else:
+                    host[0] += 1
+                    if host[1] is None:
+                        host[1] = increments
+                    elif increments is not None:
+                        host[1] = map(operator.add, host[1], increments)
+                    host[2] = map(operator.add, host[2], values)
+                    host[3] = map(max, host[3], values)
+                    host[4] = min(host[4], uptime_seconds)
+
+        if by_host:
+            self._executor_counts[component] = executor_counts
+        if hosts:
+            self.report_executor_hosts(config, tags, hosts)
+
+    def report_executor_hosts(self, config, tags, hosts):
+        """
+        Report a task ID's executors rolled up per host: how much their counters went up
+        since the last run, and the mean and maximum of their latencies and capacity.
+        """
+        names = self.metric_names(config)
+        counters = [names['executor_host.%s_total' % key] for key in self.EXECUTOR_COUNTERS]
+        means = [names['executor_host.%s.avg' % metric] for metric, _, _ in self.EXECUTOR_GAUGES]
+        maxima = [names['executor_host.%s.max' % metric] for metric, _, _ in self.EXECUTOR_GAUGES]
+        for host, (executors, increments, sums, highest, uptime_seconds) in hosts.iteritems():
+            host_tags = tags + ('storm_host:' + host,)
+            self.gauge(names['executor_host.executors_total'], executors, tags=host_tags)
+            # None until one of the host's executors was seen on a previous run
+            if increments is not None:
+                for metric, increment in zip(counters, increments):
+                    self.count(metric, increment, tags=host_tags)
+            for metric, total in zip(means, sums):
+                self.gauge(metric, total / executors, tags=host_tags)
+            for metric, value in zip(maxima, highest):
+                self.gauge(metric, value, tags=host_tags)
+            self.gauge(names['executor_host.uptime_seconds.min'], uptime_seconds, tags=host_tags)
@@ -3,20 +3,30 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../lib')
+sys.path.insert(1, agent_lib_dir)
 
 # stdlib
-from fnmatch import fnmatch
-from os import stat
-from os.path import abspath, basename, exists, join
+from fnmatch import translate
+from os import rename, stat
+from os.path import abspath, exists, join
+from multiprocessing.pool import ThreadPool
+import heapq
+import json
+import tempfile
 import time
 import re
 
 # 3p
-from scandir import walk
+from scandir import scandir
 
 # project
 from checks import AgentCheck
 from config import _is_affirmative
+from helpers import compile_regex, lru_cache
 
 
 class SubDirSizesCheck(AgentCheck):
@@ -29,11 +39,24 @@ class SubDirSizesCheck(AgentCheck):
         "dirtagname" - string, the name of the tag used for the directory. defaults to "name"
         "subdirtagname" - string, the name of the tag used for the subdirectory. defaults to "subdir"
         "subdirgauges" - boolean, when true a total stat will be emitted for each subdirectory. default False
-        "pattern" - string, the `fnmatch` pattern to use when reading the "directory"'s files. default "*"
+        "pattern" - string or list, the `fnmatch` patterns files must match one of to be counted. Patterns without a "/"
+            are matched against file names, others against the whole path. default "*"
+        "exclude" - string or list, `fnmatch` patterns of files not to count, matched like "pattern". default []
         "recurse" - boolean, when true gather stats for the subdirectories recursively. default False
+        "workers" - integer, how many subdirectories to walk at once. default 1
+        "max_walk_seconds" - number, stop walking after this long, reporting what was found so far. default unlimited
+        "cache" - string, a file to keep the sizes of directories in, so unchanged ones aren't listed again. default None
+        "full_rescan_seconds" - number, how often to list every directory regardless of the cache. default 3600
+        "size_histogram" - boolean, when true emit how many files of each size (in powers of 2) each subdirectory has. default False
+        "top_directories" - integer, emit the sizes of this many of the directories with the most bytes of files directly in them. default 0
     """
 
     SOURCE_TYPE_NAME = 'system'
+    FULL_RESCAN_SECONDS = 3600
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self._caches = {}
 
     def check(self, instance):
         if "directory" not in instance:
@@ -44,65 +67,90 @@ class SubDirSizesCheck(AgentCheck):
         dirtagname = instance.get("dirtagname", "name")
         subdirtagname = instance.get("subdirtagname", "subdir")
         subdirtagname_regex = instance.get("subdirtagname_regex", "")
-        pattern = instance.get("pattern", "*")
+        patterns = instance.get("pattern", "*")
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        excludes = instance.get("exclude", [])
+        if isinstance(excludes, basestring):
+            excludes = [excludes]
+        accept = file_filter(tuple(patterns), tuple(excludes))
         recurse = instance.get("recurse", False)
+        workers = int(instance.get("workers", 1))
+        max_walk_seconds = instance.get("max_walk_seconds")
+        size_histogram = _is_affirmative(instance.get("size_histogram", False))
+        top_directories = int(instance.get("top_directories", 0))
+
+        deadline = None
+        if max_walk_seconds:
+            deadline = time.time() + float(max_walk_seconds)
+
+        cache = None
+        if instance.get("cache"):
+            cache = self._get_cache(instance["cache"], [list(patterns), list(excludes)])
+            cache.begin(float(instance.get("full_rescan_seconds", self.FULL_RESCAN_SECONDS)))
 
         if not exists(abs_directory):
             raise Exception("DirectoryCheck: the directory (%s) does not exist" % abs_directory)
 
-        self._get_stats(abs_directory, dirtagname, subdirtagname, subdirtagname_regex, pattern, recurse)
+        self._get_stats(abs_directory, dirtagname, subdirtagname, subdirtagname_regex, accept, recurse, workers, deadline, cache,
+                        size_histogram, top_directories)
+
+    def _get_cache(self, path, signature):
+        cache = self._caches.get(path)
+        if cache is None or cache.signature != signature:
+            cache = self._caches[path] = DirectorySizeCache(path, signature)
+        return cache
 
-    def _get_stats(self, directory, dirtagname, subdirtagname, subdirtagname_regex, pattern, recurse):
+    def _get_stats(self, directory, dirtagname, subdirtagname, subdirtagname_regex, accept, recurse, workers=1, deadline=None, cache=None,
+                   size_histogram=False, top_directories=0):
         orig_dirtags = [dirtagname + ":%s" % directory]
         pat = re.compile(subdirtagname_regex)
 
         # Initialize state for subdirectories
         subdirs = {}
-        for root, dirs, files in walk(directory):
-            if root == directory:
-                for d in dirs:
-                    subdir_path = join(root, d)
-                    if subdirtagname_regex:
-                        m = pat.match(d)
-                        if m:
-                            # Subdir matches
-                            tags = ["%s:%s" % (tagname, tagvalue) for tagname, tagvalue in m.groupdict().iteritems()]
-                            subdirs[subdir_path] = {'name': d, 'files': 0, 'bytes': 0, 'tags': tags}
-                    else:
-                        subdir_tag_value = d
-                        tags = ["%s:%s" % (subdirtagname, subdir_tag_value)]
-                        subdirs[subdir_path] = {'name': d, 'files': 0, 'bytes': 0, 'tags': tags}
-
-                # There should only be one case where root == directory, so safe to break
-                break
-
-
-        # Walk the entire directory and accumulate counts
-        for root, dirs, files in walk(directory):
-            directory_files = 0
-            subdir_bytes = 0
+        to_walk = []
+        for entry in scandir(directory):
+            if not entry.is_dir():
+                continue
 
-            for filename in files:
-                filename = join(root, filename)
-                # check if it passes our filter
-                if not fnmatch(filename, pattern):
+            d = entry.name
+            if subdirtagname_regex:
+                m = pat.match(d)
+                if not m:
                     continue
+                # Subdir matches
+                tags = ["%s:%s" % (tagname, tagvalue) for tagname, tagvalue in m.groupdict().iteritems()]
+            else:
+                subdir_tag_value = d
+                tags = ["%s:%s" % (subdirtagname, subdir_tag_value)]
+            subdirs[entry.path] = {'name': d, 'files': 0, 'bytes': 0, 'duration': 0, 'truncated': False, 'buckets': [],
+                                   'largest': [], 'tags': tags}
 
-                directory_files += 1
+            # Symlinks to directories are reported, but (as with os.walk) not followed
+            if not entry.is_symlink():
+                to_walk.append(entry.path)
 
-                try:
-                    file_stat = stat(filename)
-                except OSError, ose:
-                    self.warning("DirectoryCheck: could not stat file %s - %s" % (filename, ose))
-                else:
-                    subdir_bytes += file_stat.st_size
+        walk = lambda subdir: self._walk_subdir(subdir, accept, recurse, deadline, cache, top_directories)
+        if workers > 1 and len(to_walk) > 1:
+            # Walking is mostly waiting on the filesystem, which other threads can do meanwhile
+            pool = ThreadPool(min(workers, len(to_walk)))
+            try:
+                walked = pool.map(walk, to_walk, chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            walked = map(walk, to_walk)
+
+        for subdir, stats in zip(to_walk, walked):
+            subdirs[subdir].update(stats)
 
-            for subdir in subdirs:
-                # Append a trailing slash to prevent bad matches
-                if root == subdir or (recurse and root.startswith("{0}/".format(subdir))):
-                    subdirs[subdir]['files'] += directory_files
-                    subdirs[subdir]['bytes'] += subdir_bytes
+        truncated = sum(1 for state in subdirs.itervalues() if state['truncated'])
+        if truncated:
+            self.warning("DirectoryCheck: ran out of time walking %d subdirectories of %s; their sizes are partial"
+                         % (truncated, directory))
 
+        if cache is not None:
+            cache.finish(complete=not truncated)
 
         # Iterate through subdirectory states and emit metrics
         for _, state in subdirs.iteritems():
@@ -112,8 +160,289 @@ class SubDirSizesCheck(AgentCheck):
             tags = state['tags']
 
             tags = list(orig_dirtags) + tags
-
+            if state['truncated']:
+                tags.append('walk_truncated:true')
 
             self.gauge("system.sub_dir.bytes", subdir_bytes, tags=tags)
             self.gauge("system.sub_dir.files", subdir_files, tags=tags)
+            self.gauge("system.sub_dir.walk_duration", state['duration'], tags=tags)
+
+            if size_histogram:
+                for bucket, count in enumerate(state['buckets']):
+                    self.gauge("system.sub_dir.files_by_size", count, tags=tags + ['size_lt:%d' % (1 << bucket)])
+
+        if top_directories:
+            largest = heapq.nlargest(top_directories, (
+                (size, files, path, subdir)
+                for subdir, state in subdirs.iteritems()
+                for size, files, path in state['largest']
+            ))
+            for size, files, path, subdir in largest:
+                tags = orig_dirtags + subdirs[subdir]['tags'] + ['path:%s' % path]
+                self.gauge("system.sub_dir.top.bytes", size, tags=tags)
+                self.gauge("system.sub_dir.top.files", files, tags=tags)
+
+    def _walk_subdir(self, subdir, accept, recurse, deadline=None, cache=None, top_directories=0):
+        """
+        Walks `subdir`, returning the number of files in it that `accept` accepts and their
+        total size, counting those in the directories below it too if `recurse`; how many
+        of those files there are of each size (`buckets[i]` counting those under 2**i bytes
+        but not under 2**(i-1)); the `top_directories` directories with the most bytes of
+        files directly in them, as (bytes, files, path); how long that took; and whether it
+        stopped short at `deadline`.
+
+        Everything under a subdirectory is only listed, and each file stat'd, once, and
+        directories that `cache` knows haven't changed not at all.
+        """
+        start = time.time()
+        subdir_files = 0
+        subdir_bytes = 0
+        subdir_buckets = []
+        largest = []
+        truncated = False
+
+        pending = [subdir]
+        while pending:
+            if deadline is not None and time.time() > deadline:
+                truncated = True
+                break
+
+            root = pending.pop()
+            cached = None
+            if cache is not None:
+                try:
+                    # before listing it, so anything changed meanwhile changes its mtime from this
+                    dir_stat = stat(root)
+                except OSError:
+                    continue
+                cached = cache.get(root, dir_stat)
+
+            if cached is not None:
+                directory_files, directory_bytes, children, buckets = cached
+            else:
+                try:
+                    directory_files, directory_bytes, children, buckets = self._list_directory(root, accept)
+                except OSError:
+                    # Like os.walk, skip directories we can't list
+                    continue
+                if cache is not None:
+                    cache.put(root, dir_stat, directory_files, directory_bytes, children, buckets)
+
+            subdir_files += directory_files
+            subdir_bytes += directory_bytes
+            add_buckets(subdir_buckets, buckets)
+            if top_directories:
+                if len(largest) < top_directories:
+                    heapq.heappush(largest, (directory_bytes, directory_files, root))
+                elif directory_bytes > largest[0][0]:
+                    heapq.heapreplace(largest, (directory_bytes, directory_files, root))
+            if recurse:
+                pending.extend(join(root, child) for child in children)
+
+        return {
+            'files': subdir_files,
+            'bytes': subdir_bytes,
+            'buckets': subdir_buckets,
+            'largest': largest,
+            'duration': time.time() - start,
+            'truncated': truncated,
+        }
+
+    def _list_directory(self, directory, accept):
+        """
+        Returns the number of files directly in `directory` that `accept` accepts, their total
+        size, the names of the directories in it (leaving out symlinks, which aren't followed),
+        and how many of the files there are of each size, as for _walk_subdir
+        """
+        directory_files = 0
+        directory_bytes = 0
+        children = []
+        buckets = []
+
+        for entry in scandir(directory):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    children.append(entry.name)
+                continue
+
+            # check if it passes our filter
+            if not accept(entry):
+                continue
+
+            directory_files += 1
+
+            try:
+                file_stat = entry.stat()
+            except OSError, ose:
+                self.warning("DirectoryCheck: could not stat file %s - %s" % (entry.path, ose))
+            else:
+                directory_bytes += file_stat.st_size
+
+                bucket = file_stat.st_size.bit_length()
+                if bucket >= len(buckets):
+                    buckets.extend([0] * (bucket + 1 - len(buckets)))
+                buckets[bucket] += 1
+
+        return directory_files, directory_bytes, children, buckets
+
+
+@lru_cache(64)
+def file_filter(patterns, excludes):
+    """
+    Returns a function telling whether a DirEntry matches any of the fnmatch `patterns` and
+    none of `excludes`. Patterns without a "/" are matched against the entry's name, and
+    the rest against its path. All the patterns of each kind are compiled into one regex.
+    """
+    def compile_patterns(patterns):
+        by_name = [translate(pattern) for pattern in patterns if '/' not in pattern]
+        by_path = [translate(pattern) for pattern in patterns if '/' in pattern]
+        return (
+            compile_regex('|'.join(by_name)).match if by_name else None,
+            compile_regex('|'.join(by_path)).match if by_path else None,
+        )
+
+    include_name, include_path = compile_patterns(patterns)
+    exclude_name, exclude_path = compile_patterns(excludes)
+    everything = '*' in patterns
+
+    def accept(entry):
+        if exclude_name is not None and exclude_name(entry.name):
+            return False
+        if exclude_path is not None and exclude_path(entry.path):
+            return False
+        if everything:
+            return True
+        return bool((include_name is not None and include_name(entry.name)) or
+                    (include_path is not None and include_path(entry.path)))
+
+    return accept
+
+
+def add_buckets(total, buckets):
+    """Adds the counts in `buckets` to those in `total`, in place"""
+    if len(buckets) > len(total):
+        total.extend([0] * (len(buckets) - len(total)))
+    for bucket, count in enumerate(buckets):
+        total[bucket] += count
+
+class DirectorySizeCache(object):
+    """
+    The number and total size of the files directly in each directory walked, how many of
+    them there are of each size, and the directories in it, as of the directory's mtime
+    and ctime. Adding, removing or renaming anything in a directory changes its mtime, so
+    while that hasn't changed there's no need to list it or stat its files again. Files
+    growing in place don't, though, which is why everything is listed afresh every
+    `full_rescan_seconds`.
+
+    Saved as JSON to `path`. What was cached for another `signature` (the patterns files
+    are matched against) is thrown away.
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.full_scan = 0
+        self.directories = {}
+        self.reuse = False
+        self.walked = {}
+        self.changed = False
+
+        try:
+            with open(path, 'r') as fh:
+                stored = json.load(fh)
+        except (IOError, ValueError):
+            return
+
+        # Anything in a cache that's truncated, edited by hand or from an older version
+        # that isn't as expected is only a cache miss
+        if not isinstance(stored, dict) or stored.get('signature') != signature:
+            return
+        full_scan = stored.get('full_scan', 0)
+        directories = stored.get('directories', {})
+        if not isinstance(full_scan, (int, long, float)) or not isinstance(directories, dict):
+            return
+        self.full_scan = full_scan
+        for directory, cached in directories.iteritems():
+            cached = self.load_entry(cached)
+            if cached is not None:
+                try:
+                    self.directories[directory.encode('latin-1')] = cached
+                except UnicodeError:
+                    pass
+
+    @staticmethod
+    def load_entry(cached):
+        """
+        Returns the [mtime, ctime, files, bytes, children, buckets] cached for a directory
+        with its children's names as bytes, or None if that's not what was stored
+        """
+        numbers = (int, long, float)
+        if not isinstance(cached, list) or len(cached) != 6:
+            return None
+        mtime, ctime, files, size, children, buckets = cached
+        if not all(isinstance(value, numbers) for value in (mtime, ctime, files, size)):
+            return None
+        if not isinstance(children, list) or not all(isinstance(child, basestring) for child in children):
+            return None
+        if not isinstance(buckets, list) or not all(isinstance(count, (int, long)) for count in buckets):
+            return None
+        try:
+            return [mtime, ctime, files, size, [child.encode('latin-1') for child in children], buckets]
+        except UnicodeError:
+            return None
+
+    def begin(self, full_rescan_seconds):
+        """Starts a walk, which lists everything if it's been `full_rescan_seconds` since the last full one"""
+        self.reuse = time.time() - self.full_scan < full_rescan_seconds
+        self.walked = {}
+        self.changed = False
+
+    def get(self, directory, dir_stat):
+        """Returns (files, bytes, children, buckets) for `directory` if it's unchanged since cached"""
+        if not self.reuse:
+            return None
+
+        cached = self.directories.get(directory)
+        if cached is None or cached[0] != dir_stat.st_mtime or cached[1] != dir_stat.st_ctime:
+            return None
+
+        self.walked[directory] = cached
+        return cached[2:]
+
+    def put(self, directory, dir_stat, files, size, children, buckets):
+        self.walked[directory] = [dir_stat.st_mtime, dir_stat.st_ctime, files, size, children, buckets]
+        self.changed = True
+
+    def finish(self, complete):
+        """
+        Ends a walk. If it was `complete`, directories it didn't come across any more are
+        forgotten, and if it also didn't use the cache, it counts as a full rescan.
+        """
+        if complete:
+            if len(self.walked) != len(self.directories):
+                self.changed = True
+            self.directories = self.walked
+            if not self.reuse:
+                self.full_scan = time.time()
+                self.changed = True
+        else:
+            self.directories.update(self.walked)
+        self.walked = {}
+
+        if self.changed:
+            self.save()
 
+    def save(self):
+        # Written next to the cache, so it can be renamed into place, with a name the
+        # check's patterns are unlikely to match
+        dirname, basename = os.path.split(abspath(self.path))
+        tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix=basename + '.', suffix='.tmp', delete=False)
+        try:
+            # Paths needn't be UTF-8, so they're stored as latin-1, which any bytes decode as
+            with tmp:
+                json.dump({'signature': self.signature, 'full_scan': self.full_scan, 'directories': self.directories},
+                          tmp, encoding='latin-1')
+            rename(tmp.name, self.path)
+        except:
+            os.remove(tmp.name)
+            raise
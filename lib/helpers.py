@@ -1,13 +1,57 @@
 import os
+import re
+import sre_constants
+import sre_parse
 
+from collections import OrderedDict
 from datetime import datetime
+from functools import wraps
 
-def reverse_readline(fh, buf_size=8192):
-    """a generator that returns the lines of a file in reverse order"""
+# the 'classic' syslog timestamp format, e.g. "Nov 28 22:00:27"
+SYSLOG_TIMESTAMP_FORMAT = '%b %d %H:%M:%S'
+SYSLOG_MONTHS = dict((name, number) for number, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+def lru_cache(maxsize=128):
+    """
+    a minimal stand-in for python 3's functools.lru_cache: memoizes a function of
+    hashable positional arguments, evicting the least recently used result once
+    `maxsize` results are cached. exceptions are not cached
+    """
+    def decorator(fn):
+        cache = OrderedDict()
+
+        @wraps(fn)
+        def wrapper(*args):
+            try:
+                result = cache.pop(args)
+            except KeyError:
+                result = fn(*args)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[args] = result
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+@lru_cache(256)
+def compile_regex(pattern, flags=0):
+    """
+    re.compile for patterns from instance configs, which are the same from one run to the
+    next: the compiled regex is remembered, so checks can ask for it every run for free
+    """
+    return re.compile(pattern, flags)
+
+def reverse_readline(fh, buf_size=8192, end=None):
+    """a generator that returns the lines of a file in reverse order, starting at `end` if given"""
     segment = None
     offset = 0
-    fh.seek(0, os.SEEK_END)
-    file_size = remaining_size = fh.tell()
+    if end is None:
+        fh.seek(0, os.SEEK_END)
+        end = fh.tell()
+    file_size = remaining_size = end
     while remaining_size > 0:
         offset = min(file_size, offset + buf_size)
         fh.seek(file_size - offset)
@@ -34,8 +78,111 @@ def reverse_readline(fh, buf_size=8192):
         yield segment
 
 
+def chunked_reverse_readline(fh, buf_size=65536, end=None, offsets=False):
+    """
+    a generator that returns the non-empty lines of a file in reverse order, reading
+    and splitting `buf_size` bytes of it at a time. with larger reads and without
+    reverse_readline's per-line bookkeeping, it takes about a third less time. only the
+    first `end` bytes of the file are read, if given. with `offsets`, returns (offset, line)
+    tuples, where offset is that of the start of the line; passing it as `end` carries
+    on from there
+    """
+    if end is None:
+        fh.seek(0, os.SEEK_END)
+        end = fh.tell()
+
+    # the start of each chunk is most likely part way through a line, which is
+    # carried over and completed with the end of the next chunk back. `position`
+    # is one past the end of the last of the lines to return
+    carried = ''
+    position = end
+    while end > 0:
+        start = max(0, end - buf_size)
+        fh.seek(start)
+        lines = fh.read(end - start).split('\n')
+        lines[-1] += carried
+        carried = lines.pop(0)
+
+        if offsets:
+            for line in reversed(lines):
+                position -= len(line)
+                if line:
+                    yield position, line
+                position -= 1
+        else:
+            for line in reversed(lines):
+                if line:
+                    yield line
+        end = start
+
+    if carried:
+        yield (0, carried) if offsets else carried
+
+
+@lru_cache(256)
+def regex_literal(pattern):
+    """
+    returns the longest run of literal characters that any string matched by
+    `pattern` has to contain, or None if there isn't one. only the top level of
+    the pattern is considered: literals inside groups or repeats don't count
+    """
+    longest = current = ''
+    for op, av in sre_parse.parse(pattern):
+        if op == sre_constants.LITERAL and av < 256:
+            current += chr(av)
+            if len(current) > len(longest):
+                longest = current
+        elif op != sre_constants.AT:
+            # anchors don't consume anything, so literals either side are adjacent
+            current = ''
+    return longest or None
+
+
+def line_prefilter(substrings, ignorecase=False):
+    """
+    returns a function telling whether a line contains any of `substrings`, for
+    cheaply ruling out lines before running an expensive regex over them. without
+    any substrings every line passes
+    """
+    substrings = tuple(substring.lower() if ignorecase else substring for substring in substrings or [])
+
+    if not substrings:
+        return lambda line: True
+    elif len(substrings) == 1:
+        substring = substrings[0]
+        if ignorecase:
+            return lambda line: substring in line.lower()
+        return lambda line: substring in line
+    elif ignorecase:
+        def prefilter(line):
+            line = line.lower()
+            return any(substring in line for substring in substrings)
+        return prefilter
+    return lambda line: any(substring in line for substring in substrings)
+
+
+@lru_cache(maxsize=1024)
+def parse_timestamp(timestamp, timestamp_format):
+    """
+    datetime.strptime, memoized since bursts of log lines share a timestamp. the
+    classic syslog format is parsed by slicing, which is much cheaper
+    """
+    if timestamp_format == SYSLOG_TIMESTAMP_FORMAT and len(timestamp) == 15 \
+            and timestamp[3] == ' ' and timestamp[6] == ' ' and timestamp[9] == ':' and timestamp[12] == ':':
+        month = SYSLOG_MONTHS.get(timestamp[0:3])
+        if month is not None:
+            try:
+                return datetime(1900, month, int(timestamp[4:6]),
+                                int(timestamp[7:9]), int(timestamp[10:12]), int(timestamp[13:15]))
+            except ValueError:
+                # let strptime decide what is wrong with it
+                pass
+
+    return datetime.strptime(timestamp, timestamp_format)
+
+
 def parse_fix_timestamp(timestamp, timestamp_format, now):
-    dt = datetime.strptime(timestamp, timestamp_format)
+    dt = parse_timestamp(timestamp, timestamp_format)
     # in the 'classic' syslog format, no year is specified. as a result,
     # we substitute in the year from the current time. On boundaries, such
     # as a timestamp on Dec 31 2018 being parsed on Jan 1 2019, the parsed
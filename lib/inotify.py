@@ -0,0 +1,95 @@
+"""
+A minimal binding for Linux's inotify, using ctypes so it needs nothing installed.
+Creating an Inotify raises OSError where inotify isn't available.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+# event masks, from <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# flags for inotify_init1
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+# struct inotify_event, less the name that follows it
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        except OSError, e:
+            raise OSError(errno.ENOSYS, "Can't load libc: %s" % e)
+        if not hasattr(_libc, 'inotify_init1'):
+            _libc = None
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+    return _libc
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+class Inotify(object):
+    """
+    A non-blocking inotify instance. `read_events` returns whatever events have queued
+    up since it was last called, as (watch descriptor, mask, cookie, name) tuples.
+    """
+
+    def __init__(self):
+        self.fd = _check(libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        """Watches `path` for the events in `mask`, returning the watch descriptor"""
+        return _check(libc().inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        _check(libc().inotify_rm_watch(self.fd, wd))
+
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,389 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from helpers import chunked_reverse_readline
+
+# when reading backwards, one in this many lines that no consumer's prefilter
+# wants is still parsed, so consumers can tell when they've read far enough
+SAMPLE_LINES = 64
+
+# shared by every check running in this process, keyed by logfile and regex
+_scanners = {}
+
+# likewise, keyed by path (or signature, for those kept in memory only)
+_indexes = {}
+
+def line_uptime(line):
+    """
+    Returns the uptime in a kernel log line's "[   12.345678]", found by slicing rather
+    than with the kernel line regex, or None if there isn't one
+    """
+    start = line.find('[')
+    end = line.find(']', start + 1)
+    if start == -1 or end == -1 or line.find('.', start, end) == -1:
+        return None
+    try:
+        return float(line[start + 1:end])
+    except ValueError:
+        return None
+
+def wants_uptimes(consumer):
+    return getattr(consumer, 'uptimes', False)
+
+def scanner(logfile, kernel_line_regex):
+    """Returns the scanner for `logfile` parsed with the compiled `kernel_line_regex`"""
+    key = (logfile, kernel_line_regex.pattern, kernel_line_regex.flags)
+    if key not in _scanners:
+        _scanners[key] = KernelLogScanner(logfile, kernel_line_regex)
+    return _scanners[key]
+
+def index(path, signature):
+    """
+    Returns the RotatedLogIndex stored at `path` (or kept in memory, if `path` is None)
+    for summaries made with `signature`
+    """
+    key = path or signature
+    if key not in _indexes or _indexes[key].signature != signature:
+        _indexes[key] = RotatedLogIndex(path, signature)
+    return _indexes[key]
+
+class Budget(object):
+    """
+    How much reading a scan is allowed to do: it's exceeded once the scan has read
+    `max_bytes`, or taken `max_seconds` (which is only looked at every CLOCK_LINES
+    lines). Either can be None, for no limit.
+    """
+
+    CLOCK_LINES = 1024
+
+    def __init__(self, max_seconds=None, max_bytes=None):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.started = time.time()
+        self.bytes = 0
+        self.lines = 0
+        self.exceeded = False
+
+    def spend(self, nbytes):
+        """Accounts for reading a line of `nbytes`, returning True if the budget is now exceeded"""
+        self.bytes += nbytes
+        self.lines += 1
+
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            self.exceeded = True
+        elif self.max_seconds is not None and not self.lines % self.CLOCK_LINES:
+            self.exceeded = self.exceeded or self.duration() >= self.max_seconds
+
+        return self.exceeded
+
+    def duration(self):
+        return time.time() - self.started
+
+def read_forward(logfile, kernel_line_regex, consumer, budget=None):
+    """
+    Hands the lines of a whole log, gzipped if its name ends in .gz, to `consumer.consume`
+    (see KernelLogScanner): those its prefilter wants, oldest first, along with the first
+    and last lines and one in every SAMPLE_LINES of the rest, for their uptimes, and the
+    uptimes either side of any reboot if it wants them. What's read is accounted to
+    `budget`, if given, but the log is always read to the end.
+    """
+    opener = gzip.open if logfile.endswith('.gz') else open
+    budget = budget or Budget()
+    records = []
+    skipped = 0
+    unparsed = None
+    uptimes = wants_uptimes(consumer) and 'uptime' in kernel_line_regex.groupindex
+    last_uptime = None
+
+    with opener(logfile, 'rb') as fh:
+        for number, line in enumerate(fh):
+            budget.spend(len(line))
+            wanted = not number or consumer.prefilter(line)
+
+            if uptimes:
+                uptime = line_uptime(line)
+                if uptime is not None:
+                    if last_uptime is not None and uptime < last_uptime:
+                        records.extend([{'uptime': last_uptime}, {'uptime': uptime}])
+                    last_uptime = uptime
+
+            if not wanted:
+                skipped += 1
+                if skipped % SAMPLE_LINES:
+                    unparsed = line
+                    continue
+
+            unparsed = None
+            result = kernel_line_regex.match(line.rstrip('\n'))
+            if result:
+                records.append(result.groupdict())
+
+    if unparsed is not None:
+        result = kernel_line_regex.match(unparsed.rstrip('\n'))
+        if result:
+            records.append(result.groupdict())
+
+    consumer.consume(records)
+
+
+class KernelLogScanner(object):
+    """
+    Reads a kernel log and parses its lines with a kernel line regex on behalf of
+    any number of consumers, so checks sharing a log (oom and segfault) read and
+    parse it once per collection interval rather than once each.
+
+    Consumers are registered with `consumer` and need:
+        prefilter(line): False if the line can't be of any interest to it
+        reset(): forget everything; the log is about to be read backwards
+        consume_backward(fields, candidate): called with the groupdict of each line
+            from the end of the log backwards, until it returns True. `candidate` is
+            False for lines the prefilter ruled out but which were parsed anyway
+        consume(records): called with the groupdicts of the lines it wants out of
+            those appended since the last scan, oldest first
+
+    Consumers with `uptimes` set, that tell reboots apart by the uptime going backwards,
+    are also handed {'uptime': <float>} (as a non-candidate going backwards) for the
+    lines either side of every reboot, even if their prefilter rules them out. Uptimes
+    are read from every line by slicing out its "[uptime]", which is much cheaper than
+    the regex, as long as the kernel line regex has an uptime group.
+    """
+
+    def __init__(self, logfile, kernel_line_regex):
+        self.logfile = logfile
+        self.kernel_line_regex = kernel_line_regex
+        self.consumers = {}
+        # consumers that haven't started reading the log backwards yet
+        self.pending = set()
+        # [offset, consumers, lines skipped, uptime of the last line read] for each group of consumers part way through
+        # reading the log backwards, when a scan ran out of budget before they were done
+        self.backward = []
+        # how far we've read forwards, the uptime of the last line read forwards,
+        # and (inode, size, mtime) the last time we caught up with the log
+        self.inode = None
+        self.offset = 0
+        self.uptime = None
+        self.stat_key = None
+        # work done by the last call to `scan`, and whether it left any undone
+        self.lines_scanned = 0
+        self.lines_regex_matched = 0
+        self.budget = Budget()
+        self.truncated = False
+
+    def consumer(self, key, factory):
+        """Returns the consumer registered as `key`, registering `factory()` if there isn't one"""
+        if key not in self.consumers:
+            self.consumers[key] = factory()
+            self.pending.add(key)
+        return self.consumers[key]
+
+    def scan(self, budget=None):
+        """
+        Brings every consumer up to date with the log, which is left alone if it hasn't
+        changed since the last scan. Raises IOError if the log can't be opened.
+
+        Given a Budget, stops once it's exceeded and sets `truncated`; the next scan picks
+        up where this one left off. Lines appended to the log are read before carrying on
+        backwards, so the latest are never held up behind a long backwards read.
+        """
+        self.lines_scanned = 0
+        self.lines_regex_matched = 0
+        self.budget = budget or Budget()
+
+        with open(self.logfile, 'rt') as fh:
+            stat = os.fstat(fh.fileno())
+            stat_key = (stat.st_ino, stat.st_size, stat.st_mtime)
+            if stat_key == self.stat_key and not self.pending:
+                self.truncated = False
+                return
+
+            # rotated or truncated: every consumer starts over from the end of the new file
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode = stat.st_ino
+                self.offset = stat.st_size
+                self.uptime = None
+                self.pending = set(self.consumers)
+                self.backward = []
+
+            if self.pending:
+                consumers = [self.consumers[key] for key in self.pending]
+                for consumer in consumers:
+                    consumer.reset()
+                self.backward.append([self.offset, consumers, 0, None])
+                self.pending = set()
+
+            if self.offset < stat.st_size:
+                self.scan_forward(fh)
+
+            while self.backward and not self.budget.exceeded:
+                self.scan_backward(fh, self.backward[0])
+                if self.backward[0][0] == 0 or not self.backward[0][1]:
+                    self.backward.pop(0)
+
+            self.truncated = bool(self.backward) or self.offset < stat.st_size
+            self.stat_key = None if self.truncated else stat_key
+
+    def scan_backward(self, fh, group):
+        """
+        Reads the log backwards from the offset in `group` until its consumers have all seen
+        enough, or the budget runs out, updating the offset, which consumers are reading and
+        how many lines they've skipped (so the sampling carries on where it left off)
+        """
+        reading = group[1]
+        uptimes = 'uptime' in self.kernel_line_regex.groupindex and any(wants_uptimes(consumer) for consumer in reading)
+        for offset, line in chunked_reverse_readline(fh, end=group[0], offsets=True):
+            if not reading or self.budget.exceeded:
+                break
+
+            group[0] = offset
+            self.budget.spend(len(line) + 1)
+            self.lines_scanned += 1
+            wanted = [consumer for consumer in reading if consumer.prefilter(line)]
+
+            if uptimes:
+                uptime = line_uptime(line)
+                if uptime is not None:
+                    # going backwards, the uptime goes up at a reboot
+                    if group[3] is not None and uptime > group[3]:
+                        self.hand_uptime_backward(reading, group[3])
+                        self.hand_uptime_backward(reading, uptime)
+                    group[3] = uptime
+
+            if not wanted:
+                group[2] += 1
+                if group[2] % SAMPLE_LINES:
+                    continue
+
+            self.lines_regex_matched += 1
+            result = self.kernel_line_regex.match(line)
+            if not result:
+                continue
+
+            fields = result.groupdict()
+            for consumer in list(reading):
+                if consumer.consume_backward(fields, consumer in wanted):
+                    reading.remove(consumer)
+        else:
+            # read all the way back to the start
+            group[0] = 0
+
+    def hand_uptime_backward(self, reading, uptime):
+        """Hands an uptime to the consumers in `reading` that want them, dropping those done reading"""
+        for consumer in list(reading):
+            if wants_uptimes(consumer) and consumer.consume_backward({'uptime': uptime}, False):
+                reading.remove(consumer)
+
+    def scan_forward(self, fh):
+        """Hands the complete lines appended since the last scan to the consumers that want them"""
+        consumers = self.consumers.values()
+        batches = dict((id(consumer), []) for consumer in consumers)
+        uptime_batches = []
+        if 'uptime' in self.kernel_line_regex.groupindex:
+            uptime_batches = [batches[id(consumer)] for consumer in consumers if wants_uptimes(consumer)]
+
+        fh.seek(self.offset)
+        for line in fh:
+            # a partially written line will be read in full on the next scan
+            if not line.endswith('\n'):
+                break
+            self.offset += len(line)
+
+            self.lines_scanned += 1
+            exceeded = self.budget.spend(len(line))
+
+            if uptime_batches:
+                uptime = line_uptime(line)
+                if uptime is not None:
+                    # going forwards, the uptime goes down at a reboot
+                    if self.uptime is not None and uptime < self.uptime:
+                        for batch in uptime_batches:
+                            batch.extend([{'uptime': self.uptime}, {'uptime': uptime}])
+                    self.uptime = uptime
+
+            wanted = [consumer for consumer in consumers if consumer.prefilter(line)]
+            if wanted:
+                self.lines_regex_matched += 1
+                result = self.kernel_line_regex.match(line.rstrip('\n'))
+                if result:
+                    fields = result.groupdict()
+                    for consumer in wanted:
+                        batches[id(consumer)].append(fields)
+
+            if exceeded:
+                break
+
+        for consumer in consumers:
+            consumer.consume(batches[id(consumer)])
+
+
+class RotatedLogIndex(object):
+    """
+    Summaries of rotated logs, which don't change once rotated, so each only has to be
+    read (and decompressed) once. Summaries are keyed by inode, size and mtime rather
+    than name, as rotating renames every file, and saved as JSON to `path` if given.
+    Summaries made with a different `signature` string (say, for another regex) are
+    thrown away.
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.summaries = {}
+
+        if path is not None:
+            try:
+                with open(path, 'r') as fh:
+                    stored = json.load(fh)
+                if stored.get('signature') == signature:
+                    self.summaries = stored.get('summaries', {})
+            except (IOError, ValueError):
+                pass
+
+    def summary(self, logfile, summarize):
+        """
+        Returns the summary of `logfile`, calling `summarize(logfile)` to make one if there isn't
+        one. `summarize` can return None to put that off, which is then returned in turn.
+        """
+        stat = os.stat(logfile)
+        key = '%d:%d:%r' % (stat.st_ino, stat.st_size, stat.st_mtime)
+
+        if key not in self.summaries:
+            summary = summarize(logfile)
+            if summary is None:
+                return None
+            self.summaries[key] = summary
+            self.save()
+
+        return self.summaries[key]
+
+    def prune(self, logfiles):
+        """Forgets the summaries of anything other than `logfiles`"""
+        keys = set()
+        for logfile in logfiles:
+            try:
+                stat = os.stat(logfile)
+            except OSError:
+                continue
+            keys.add('%d:%d:%r' % (stat.st_ino, stat.st_size, stat.st_mtime))
+
+        if set(self.summaries) - keys:
+            self.summaries = dict((key, self.summaries[key]) for key in keys if key in self.summaries)
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+
+        # Written next to the index, so it can be renamed into place, with a name the
+        # rotated logs' pattern is unlikely to match
+        dirname, basename = os.path.split(os.path.abspath(self.path))
+        tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix=basename + '.', suffix='.tmp', delete=False)
+        try:
+            with tmp:
+                json.dump({'signature': self.signature, 'summaries': self.summaries}, tmp)
+            os.rename(tmp.name, self.path)
+        except:
+            os.remove(tmp.name)
+            raise
@@ -1,30 +1,25 @@
+import hashlib
+import json
+import os
 import re
 
-TIMESPEC_RE = re.compile('^(\d+)([a-z])$')
+from helpers import lru_cache
 
+# Storm writes durations largest unit first, like "1d 2h 3m 4s", leaving out the zeros.
+# Matched with a space after the last component.
+TIMESPEC_RE = re.compile('^ *(?:(\d+)w +)?(?:(\d+)d +)?(?:(\d+)h +)?(?:(\d+)m +)?(?:(\d+)s +)?$')
+
+@lru_cache(4096)
 def translate_timespec(string):
     """Parses a storm duration-ish timespec like "5m 20s" and returns the
-    corresponding number of seconds.
-    """
-    components = string.split(' ')
-    time_translator = {
-        'w': 60*60*24*7,
-        'd': 60*60*24,
-        'h': 60*60,
-        'm': 60,
-        's': 1,
-    }
-    res = 0
-    for component in components:
-        if component == '':
-            continue
-        match = TIMESPEC_RE.match(component)
-        if match is None:
-            raise ValueError("Can't parse the timespec", string, 'component=', component)
-        multiplier = time_translator[match.group(2)]
-        number = int(match.group(1))
-        res += multiplier * number
-    return res
+    corresponding number of seconds. The executors of a topology mostly have
+    the same uptime, so the last few thousand are remembered.
+    """
+    match = TIMESPEC_RE.match(string + ' ')
+    if match is None:
+        raise ValueError("Can't parse the timespec", string)
+    weeks, days, hours, minutes, seconds = match.groups(0)
+    return int(weeks)*60*60*24*7 + int(days)*60*60*24 + int(hours)*60*60 + int(minutes)*60 + int(seconds)
 
 
 def _topology_name(topology_re, topology):
@@ -40,14 +35,112 @@ def collect_topologies(topology_re, topologies):
     Filter out topologies matching the regex, and collect the newest ACTIVE one.
     Returns a dictionary of the form `{taggable_name: topology}`
     """
-    ret = dict()
+    # name -> (uptime, topology) of the youngest so far
+    youngest = dict()
     for topo in topologies:
         name = _topology_name(topology_re, topo)
         # Skip if the topology name doesn't match the ones we want:
         if name is None or topo.get('status', 'KILLED') != 'ACTIVE':
             continue
-        if name not in ret:
-            ret[name] = []
-        ret[name].append(topo)
-    topo_key = lambda x: translate_timespec(x['uptime'])
-    return {name: sorted(value, key=topo_key)[0] for name, value in ret.iteritems()}
+        uptime = translate_timespec(topo['uptime'])
+        if name not in youngest or uptime < youngest[name][0]:
+            youngest[name] = (uptime, topo)
+    return dict((name, topo) for name, (_, topo) in youngest.iteritems())
+
+
+def dump_cache(cached, fh, cache_format='json'):
+    """
+    Writes a storm cache to `fh`, either as one JSON document (`json`), or (`lines`) as
+    everything but the topologies' details on the first line, then each topology's details
+    on a line of its own, after a digest of them and when it and its components were
+    updated. Readers of `lines` caches can then tell which topologies changed without
+    parsing them. The updated times are left out of the digest, as they change every time
+    a topology's fetched even if nothing else does.
+    """
+    if cache_format == 'json':
+        json.dump(cached, fh)
+        return
+    if cache_format != 'lines':
+        raise ValueError("Unknown cache format %r, expected json or lines" % cache_format)
+
+    header = dict(cached, format='lines')
+    topology_details = []
+    if 'data' in cached:
+        header['data'] = dict(cached['data'])
+        topology_details = header['data'].pop('topology_details', [])
+
+    fh.write(json.dumps(header) + '\n')
+    for topology in topology_details:
+        topology, updated = split_updated(topology)
+        encoded = json.dumps(topology, sort_keys=True)
+        fh.write('%s\t%s\t%s\n' % (hashlib.md5(encoded).hexdigest(), updated, encoded))
+
+
+def split_updated(topology):
+    """
+    Returns a copy of a topology's details without its or its components' `updated` times,
+    and those times, comma-separated: the topology's first, then its components' in order
+    """
+    topology = dict(topology)
+    updated = [topology.pop('updated', None)]
+    if topology.get('component_details'):
+        topology['component_details'] = [dict(component) for component in topology['component_details']]
+        updated.extend(component.pop('updated', None) for component in topology['component_details'])
+    return topology, ','.join('' if value is None else repr(value) for value in updated)
+
+
+def join_updated(topology, updated):
+    """Returns a copy of a topology's details with the `updated` times split_updated took out"""
+    updated = [float(value) if value else None for value in updated.split(',')]
+    topology = dict(topology)
+    if updated[0] is not None:
+        topology['updated'] = updated[0]
+    if len(updated) > 1:
+        topology['component_details'] = [dict(component) for component in topology['component_details']]
+        for component, value in zip(topology['component_details'], updated[1:]):
+            if value is not None:
+                component['updated'] = value
+    return topology
+
+
+class CacheReader(object):
+    """
+    Reads the storm cache at `path`, in either format dump_cache writes. While the file's
+    unchanged, what was read last time is returned again; otherwise, from `lines` caches,
+    only the topologies that have changed since, other than when they were updated, are
+    parsed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat_key = None
+        self.cached = None
+        self.topologies = {}
+
+    def read(self):
+        stat = os.stat(self.path)
+        stat_key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        if stat_key == self.stat_key:
+            return self.cached
+
+        with open(self.path, 'r') as cache_f:
+            # the whole of a json cache, or the first line of a lines one
+            cached = json.loads(cache_f.readline())
+            if cached.get('format') == 'lines':
+                topologies = {}
+                topology_details = []
+                for line in cache_f:
+                    digest, updated, encoded = line.rstrip('\n').split('\t', 2)
+                    topology = self.topologies.get(digest)
+                    if topology is None:
+                        topology = json.loads(encoded)
+                    topologies[digest] = topology
+                    topology_details.append(join_updated(topology, updated))
+
+                self.topologies = topologies
+                if 'data' in cached:
+                    cached['data']['topology_details'] = topology_details
+
+        self.stat_key = stat_key
+        self.cached = cached
+        return cached
@@ -0,0 +1,232 @@
+"""
+Generates synthetic kern.log files for the benchmarks: syslog-formatted kernel lines
+of mostly noise, with segfaults and OOM kills mixed in, and the machine rebooting
+at given points through the file.
+
+    python -m tests.benchmarks.kernlog --size 100M --reboots 0.2,0.9 kern.log
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+HOST = 'bench'
+
+FILLER = [
+    'e1000: eth0 NIC Link is Up 1000 Mbps Full Duplex, Flow Control: RX',
+    'IPv6: ADDRCONF(NETDEV_UP): eth0: link is not ready',
+    'audit: type=1400 audit(%(epoch)d.%(ms)03d:%(seq)d): apparmor="STATUS" operation="profile_replace" profile="unconfined" name="/usr/sbin/ntpd" pid=%(pid)d comm="apparmor_parser"',
+    'TCP: request_sock_TCP: Possible SYN flooding on port %(port)d. Sending cookies.  Check SNMP counters.',
+    'EXT4-fs (xvda1): re-mounted. Opts: (null)',
+    'nf_conntrack: nf_conntrack: table full, dropping packet',
+    '[UFW BLOCK] IN=eth0 OUT= MAC=0a:1b:2c:3d:4e:5f:0a:1b:2c:3d:4e:5f:08:00 SRC=10.0.%(a)d.%(b)d DST=10.0.0.1 LEN=40 TOS=0x00 PREC=0x00 TTL=243 ID=%(seq)d PROTO=TCP SPT=%(port)d DPT=22 WINDOW=1024 RES=0x00 SYN URGP=0',
+    'device veth%(ip)07x entered promiscuous mode',
+]
+
+SEGFAULT = [
+    '%(pname)s[%(pid)d]: segfault at 0 ip 00007f%(ip)08x sp 00007ffd%(sp)08x error 4 in %(pname)s[400000+b59000]',
+]
+
+OOM = [
+    '%(pname)s invoked oom-killer: gfp_mask=0x24201ca, order=0, oom_score_adj=0',
+    '%(pname)s cpuset=/ mems_allowed=0',
+    'Out of memory: Kill process %(pid)d (%(pname)s) score %(score)d or sacrifice child',
+    'Killed process %(pid)d (%(pname)s) total-vm:1322952kB, anon-rss:443860kB, file-rss:0kB',
+]
+
+BOOT = [
+    'Initializing cgroup subsys cpuset',
+    'Initializing cgroup subsys cpu',
+    'Initializing cgroup subsys cpuacct',
+    'Linux version 4.4.0-47-generic (buildd@lgw01-12) (gcc version 4.8.4 (Ubuntu 4.8.4-2ubuntu1~14.04.3) ) #68~14.04.1-Ubuntu SMP Wed Oct 26 19:42:11 UTC 2016 (Ubuntu 4.4.0-47.68~14.04.1-generic 4.4.24)',
+    'Command line: BOOT_IMAGE=/boot/vmlinuz-4.4.0-47-generic root=UUID=3b4d8a39-5b36-4f4c-9d43-5c1a1d8f5e0a ro console=tty1 console=ttyS0',
+    'KERNEL supported cpus:',
+    '  Intel GenuineIntel',
+    '  AMD AuthenticAMD',
+]
+
+PROCESS_NAMES = ['envoy', 'node', 'java', 'nginx', 'python2.7', 'haproxy']
+
+# what each kind of event writes, and how often it happens by default
+EVENTS = {
+    'filler': FILLER,
+    'segfault': SEGFAULT,
+    'oom': OOM,
+}
+DEFAULT_MIX = {'filler': 0.995, 'segfault': 0.004, 'oom': 0.001}
+
+# the syslog timestamp of the first line; uptimes start from zero there
+START = 1543442427
+
+
+def parse_size(size):
+    """'10M' -> 10485760"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_mix(mix):
+    """'filler=0.99,oom=0.01' -> {'filler': 0.99, 'oom': 0.01}"""
+    weights = {}
+    for item in mix.split(','):
+        event, weight = item.split('=')
+        if event not in EVENTS:
+            raise ValueError("Unknown event %r, expected one of %s" % (event, ', '.join(sorted(EVENTS))))
+        weights[event] = float(weight)
+    return weights
+
+
+def generate(filename, size, mix=None, reboots=(), interval=0.05, seed=0):
+    """
+    Writes about `size` bytes of kernel log to `filename`, with events chosen by the
+    weights in `mix` and one line every `interval` seconds on average. The machine
+    boots at the start, and again `reboots` (fractions of `size`) of the way through.
+
+    Returns a dict describing what was written, including the syslog timestamp of
+    the last line (`end`, seconds since the epoch) and the number of each kind of
+    event since the last boot.
+    """
+    rand = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    events = sorted(mix)
+    weights = [mix[event] for event in events]
+    reboot_offsets = sorted(int(fraction * size) for fraction in reboots)
+
+    now = float(START)
+    uptime = 0.0
+    lines = 0
+    since_boot = dict((event, 0) for event in events)
+    timestamps = {}
+
+    def format_lines(messages):
+        stamp = int(now)
+        if stamp not in timestamps:
+            timestamps.clear()
+            timestamps[stamp] = time.strftime('%b %d %H:%M:%S', time.gmtime(stamp))
+        prefix = '%s %s kernel: [%12.6f] ' % (timestamps[stamp], HOST, uptime)
+        return [prefix + message + '\n' for message in messages]
+
+    with open(filename, 'wb') as fh:
+        pending = format_lines(BOOT)
+        written = sum(len(line) for line in pending)
+        while written < size:
+            if reboot_offsets and written >= reboot_offsets[0]:
+                reboot_offsets.pop(0)
+                uptime = 0.0
+                since_boot = dict((event, 0) for event in events)
+                new = format_lines(BOOT)
+            else:
+                event = weighted_choice(rand, events, weights)
+                since_boot[event] += 1
+                values = event_values(rand, now, lines + len(pending))
+                new = format_lines([template % values for template in event_templates(rand, event)])
+
+                step = rand.uniform(0, 2 * interval)
+                now += step
+                uptime += step
+
+            written += sum(len(line) for line in new)
+            pending.extend(new)
+
+            if len(pending) >= 10000:
+                lines += len(pending)
+                fh.writelines(pending)
+                pending = []
+
+        lines += len(pending)
+        fh.writelines(pending)
+
+    return {
+        'size': os.path.getsize(filename),
+        'lines': lines,
+        'end': int(now),
+        'since_boot': since_boot,
+    }
+
+
+def event_templates(rand, event):
+    """The templates for the lines one `event` writes"""
+    if event == 'filler':
+        return [rand.choice(FILLER)]
+    return EVENTS[event]
+
+
+def event_values(rand, now, seq):
+    """Values to fill the templates in with"""
+    return {
+        'epoch': int(now),
+        'ms': rand.randint(0, 999),
+        'seq': seq,
+        'pid': rand.randint(100, 32767),
+        'port': rand.randint(1024, 65535),
+        'a': rand.randint(0, 255),
+        'b': rand.randint(0, 255),
+        'ip': rand.randint(0, 0xfffffff),
+        'sp': rand.randint(0, 0xfffffff),
+        'pname': rand.choice(PROCESS_NAMES),
+        'score': rand.randint(0, 1000),
+    }
+
+
+def weighted_choice(rand, choices, weights):
+    target = rand.uniform(0, sum(weights))
+    for choice, weight in zip(choices, weights):
+        target -= weight
+        if target <= 0:
+            return choice
+    return choices[-1]
+
+
+def cached(directory, size, mix=None, reboots=(), interval=0.05, seed=0):
+    """
+    Returns the path to a generated log and its description, generating it
+    into `directory` only if one with the same parameters isn't already there
+    """
+    params = {
+        'size': size,
+        'mix': mix or DEFAULT_MIX,
+        'reboots': list(reboots),
+        'interval': interval,
+        'seed': seed,
+    }
+    name = 'kern-%s.log' % abs(hash(json.dumps(params, sort_keys=True)))
+    filename = os.path.join(directory, name)
+    described = filename + '.json'
+
+    if os.path.exists(filename) and os.path.exists(described):
+        with open(described, 'r') as fh:
+            return filename, json.load(fh)
+
+    description = generate(filename, size, mix, reboots, interval, seed)
+    with open(described, 'w') as fh:
+        json.dump(description, fh)
+    return filename, description
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic kern.log')
+    parser.add_argument('filename')
+    parser.add_argument('--size', default='10M', help='roughly how big a file to write, e.g. 10M or 2G')
+    parser.add_argument('--mix', default=None, help='event weights, e.g. filler=0.99,segfault=0.008,oom=0.002')
+    parser.add_argument('--reboots', default='', help='where the machine reboots, as fractions of the file, e.g. 0.5,0.9')
+    parser.add_argument('--interval', type=float, default=0.05, help='average seconds between lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    description = generate(
+        args.filename,
+        parse_size(args.size),
+        parse_mix(args.mix) if args.mix else None,
+        [float(fraction) for fraction in args.reboots.split(',') if fraction],
+        args.interval,
+        args.seed,
+    )
+    print json.dumps(description, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Times the kernel log parsing paths (the oom and segfault checks, and the reverse line
+readers they're built on) over generated logs, reporting the best wall time of a few
+runs and the most memory any of them needed on top of what the process had already.
+
+    python -m tests.benchmarks.run --size 100M --reboots 0.5 --save baseline.json
+    python -m tests.benchmarks.run --size 100M --reboots 0.5 --compare baseline.json
+
+With --compare, exits non-zero if any case got more than --tolerance (and --slack
+seconds) slower than the baseline, which is only meaningful if the baseline was saved on the same machine with
+the same parameters.
+"""
+
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../lib')
+sys.path.insert(1, agent_lib_dir)
+
+# stdlib
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+# project
+import helpers
+from tests.benchmarks import kernlog
+from tests.checks.common import load_check
+
+KERNEL_LINE_REGEX = '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$'
+KILL_MESSAGE_REGEX = '^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child'
+PROCESS_NAME_REGEX = '^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault'
+TIMESTAMP_FORMAT = '%b %d %H:%M:%S'
+
+# lines appended to the log between runs of the incremental cases
+APPEND_LINES = 1000
+
+# every case is handed the generated log and its description, does any setup it needs,
+# and returns the function to time
+CASES = OrderedDict()
+
+def case(fn):
+    CASES[fn.__name__] = fn
+    return fn
+
+def oom_instance(logfile):
+    return {
+        'logfile': logfile,
+        'kernel_line_regex': KERNEL_LINE_REGEX,
+        'kill_message_regex': KILL_MESSAGE_REGEX,
+    }
+
+def segfault_instance(logfile, description, window, **options):
+    instance = {
+        'logfile': logfile,
+        'kernel_line_regex': KERNEL_LINE_REGEX,
+        'process_name_regex': PROCESS_NAME_REGEX,
+        'timestamp_format': TIMESTAMP_FORMAT,
+        'time_window_seconds': window,
+        'mock_now': datetime.utcfromtimestamp(description['end']),
+    }
+    instance.update(options)
+    return instance
+
+def appendable_copy(logfile, scratch):
+    """Copies the log, and returns the copy with a function appending more lines to it"""
+    copy = os.path.join(scratch, 'appended.log')
+    shutil.copyfile(logfile, copy)
+
+    with open(logfile, 'rb') as fh:
+        fh.seek(max(0, os.path.getsize(logfile) - APPEND_LINES * 200))
+        more = fh.readlines()[-APPEND_LINES:]
+
+    def append():
+        with open(copy, 'ab') as fh:
+            fh.writelines(more)
+
+    return copy, append
+
+@case
+def reverse_readline(logfile, description, options):
+    def run():
+        with open(logfile, 'rt') as fh:
+            for _ in helpers.reverse_readline(fh):
+                pass
+    return run
+
+@case
+def chunked_reverse_readline(logfile, description, options):
+    def run():
+        with open(logfile, 'rt') as fh:
+            for _ in helpers.chunked_reverse_readline(fh):
+                pass
+    return run
+
+@case
+def chunked_reverse_offsets(logfile, description, options):
+    # as the kernel log scanner reads backwards
+    def run():
+        with open(logfile, 'rt') as fh:
+            for _ in helpers.chunked_reverse_readline(fh, offsets=True):
+                pass
+    return run
+
+@case
+def oom(logfile, description, options):
+    check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+    return lambda: check.check(oom_instance(logfile))
+
+@case
+def oom_incremental(logfile, description, options):
+    copy, append = appendable_copy(logfile, options.scratch)
+    check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+    check.check(oom_instance(copy))
+    append()
+    return lambda: check.check(oom_instance(copy))
+
+@case
+def segfault(logfile, description, options):
+    check = load_check('segfault', {'init_config': {}, 'instances': []}, {})
+    return lambda: check.check(segfault_instance(logfile, description, options.window))
+
+@case
+def segfault_tail(logfile, description, options):
+    copy, append = appendable_copy(logfile, options.scratch)
+    check = load_check('segfault', {'init_config': {}, 'instances': []}, {})
+    check.check(segfault_instance(copy, description, options.window, tail=True))
+    append()
+    return lambda: check.check(segfault_instance(copy, description, options.window, tail=True))
+
+def measure(name, logfile, description, options, results):
+    """Runs a case in this (forked) process, putting its timing on `results`"""
+    options.scratch = tempfile.mkdtemp(dir=options.workdir)
+    try:
+        run = CASES[name](logfile, description, options)
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        run()
+        seconds = time.time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        results.put({'seconds': seconds, 'peak_rss_kb': rss_after - rss_before})
+    finally:
+        shutil.rmtree(options.scratch)
+
+def benchmark(name, logfile, description, options):
+    """
+    Returns the best time and the highest memory use of `options.repeat` runs of a case,
+    each in a process of its own so nothing (like the kernel log scanners) carries over
+    """
+    runs = []
+    for _ in range(options.repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(name, logfile, description, options, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception("Benchmark %s failed with exit code %s" % (name, process.exitcode))
+        runs.append(results.get())
+
+    return {
+        'seconds': min(run['seconds'] for run in runs),
+        'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+    }
+
+def compare(results, baseline, tolerance, slack):
+    """
+    Returns the names of the cases more than `tolerance` slower than `baseline`, ignoring
+    differences of less than `slack` seconds, which are mostly noise
+    """
+    regressions = []
+    for name, result in results.iteritems():
+        if name not in baseline:
+            continue
+
+        allowed = max(baseline[name]['seconds'] * (1 + tolerance), baseline[name]['seconds'] + slack)
+        if result['seconds'] > allowed:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the kernel log parsing checks')
+    parser.add_argument('--size', default='10M', help='roughly how big a log to generate, e.g. 10M or 2G')
+    parser.add_argument('--mix', default=None, help='event weights, e.g. filler=0.99,segfault=0.008,oom=0.002')
+    parser.add_argument('--reboots', default='0.5', help='where the machine reboots, as fractions of the log')
+    parser.add_argument('--window', type=int, default=3600, help='time_window_seconds for the segfault check')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case to take the best of')
+    parser.add_argument('--cases', default=','.join(CASES), help='which of %s to run' % ', '.join(CASES))
+    parser.add_argument('--workdir', default=tempfile.gettempdir(), help='where generated logs are kept between runs')
+    parser.add_argument('--save', help='write the results to this file, as a baseline')
+    parser.add_argument('--compare', help='compare the results against the baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much slower than the baseline is a regression')
+    parser.add_argument('--slack', type=float, default=0.05, help='seconds slower than the baseline that are never a regression')
+    options = parser.parse_args()
+
+    params = {
+        'size': kernlog.parse_size(options.size),
+        'mix': kernlog.parse_mix(options.mix) if options.mix else None,
+        'reboots': [float(fraction) for fraction in options.reboots.split(',') if fraction],
+    }
+    logfile, description = kernlog.cached(options.workdir, **params)
+    params['window'] = options.window
+    print "%s: %d lines, %d bytes" % (logfile, description['lines'], description['size'])
+
+    results = OrderedDict()
+    for name in options.cases.split(','):
+        results[name] = benchmark(name, logfile, description, options)
+        print "%-24s %10.3fs %10d KB" % (name, results[name]['seconds'], results[name]['peak_rss_kb'])
+
+    if options.save:
+        with open(options.save, 'w') as fh:
+            json.dump({'params': params, 'results': results}, fh, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare, 'r') as fh:
+            baseline = json.load(fh)
+
+        if baseline['params'] != json.loads(json.dumps(params)):
+            print >> sys.stderr, "The baseline was run with %s; not comparing" % baseline['params']
+            sys.exit(2)
+
+        regressions = compare(results, baseline['results'], options.tolerance, options.slack)
+        for name in regressions:
+            print >> sys.stderr, "%s: %.3fs, was %.3fs" % (name, results[name]['seconds'], baseline['results'][name]['seconds'])
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
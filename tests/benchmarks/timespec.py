@@ -0,0 +1,57 @@
+"""
+Times how the storm_rest_api check parses its executors' uptimes: translate_timespec
+with its cache cleared before each run and kept between them, against parsing a
+component at a time as it used to, reporting the best wall time of a few runs.
+
+    python -m tests.benchmarks.timespec --executors 5000 --uptimes 5
+
+Exits non-zero if the memoized parser, even with its cache cleared, is the slower one.
+"""
+
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../lib')
+sys.path.insert(1, agent_lib_dir)
+
+# stdlib
+import argparse
+import timeit
+
+# project
+import storm_utils
+from tests.storm_timespecs import split_timespec
+
+def best(parse, uptimes, repeat, setup=lambda: None):
+    """The best wall time of `repeat` runs of `parse` over every uptime, after `setup`"""
+    def run():
+        setup()
+        for uptime in uptimes:
+            parse(uptime)
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing storm executors' uptimes")
+    parser.add_argument('--executors', type=int, default=5000, help="how many executors' uptimes to parse")
+    parser.add_argument('--uptimes', type=int, default=5, help='how many different uptimes they have between them')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each parser to take the best of')
+    options = parser.parse_args()
+
+    # a component's executors, started within a few seconds of each other
+    uptimes = ['3d 4h 12m %ds' % (i % options.uptimes) for i in range(options.executors)]
+    results = [
+        ('split', best(split_timespec, uptimes, options.repeat)),
+        ('memoized_cold', best(storm_utils.translate_timespec, uptimes, options.repeat,
+                               setup=storm_utils.translate_timespec.cache_clear)),
+        ('memoized_warm', best(storm_utils.translate_timespec, uptimes, options.repeat)),
+    ]
+    print "%d uptimes, %d different" % (options.executors, options.uptimes)
+    for name, seconds in results:
+        print "%-24s %10.4fs" % (name, seconds)
+
+    if results[1][1] > results[0][1]:
+        print >> sys.stderr, "memoized parsing is slower than a component at a time"
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
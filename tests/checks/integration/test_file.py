@@ -1,4 +1,12 @@
-from tempfile import mkstemp, gettempdir
+from os import path
+from tempfile import mkdtemp, mkstemp, gettempdir
+import errno
+import glob
+import os
+import shutil
+
+# 3p
+from mock import Mock, patch
 
 # project
 from checks import AgentCheck
@@ -85,3 +93,163 @@ class TestFileUnit(AgentCheckTest):
         service_checks = self.check.get_service_checks()
         self.assertTrue(service_checks[0]['status'] == AgentCheck.CRITICAL)
         self.assert_tags(['expected_status:absent'], service_checks[0]['tags'])
+
+    def test_glob_oldest(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        ctimes = {'a': 300, 'b': 100, 'c': 200}
+        for name in ctimes:
+            open(path.join(dirname, name), 'w').close()
+
+        def fake_stat(filename):
+            return Mock(st_ctime=ctimes[path.basename(filename)])
+
+        self.check = load_check('file', {'init_config': {}, 'instances': []}, {})
+
+        # each file is only stat'd once
+        with patch('os.stat', side_effect=fake_stat) as stat:
+            status, statinfo = self.check.stat_file(path.join(dirname, '*'))
+        self.assertEqual(3, stat.call_count)
+        self.assertEqual('present', status)
+        self.assertEqual(100, statinfo.st_ctime)
+
+        # files removed after globbing are skipped
+        def vanishing_stat(filename):
+            if path.basename(filename) == 'b':
+                raise OSError(errno.ENOENT, 'No such file or directory')
+            return fake_stat(filename)
+
+        with patch('os.stat', side_effect=vanishing_stat):
+            status, statinfo = self.check.stat_file(path.join(dirname, '*'))
+        self.assertEqual('present', status)
+        self.assertEqual(200, statinfo.st_ctime)
+
+    def test_iglob(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        for name in ['a.log', 'b.log', 'c.txt', '.hidden.log', 'sub/d.log']:
+            if not path.exists(path.dirname(path.join(dirname, name))):
+                os.makedirs(path.dirname(path.join(dirname, name)))
+            open(path.join(dirname, name), 'w').close()
+
+        self.check = load_check('file', {'init_config': {}, 'instances': []}, {})
+        for pattern in ['*.log', '*', '.*', '[ab].log', '?.txt', '*/*.log', 'a.log', 'nope', 'nope/*']:
+            pattern = path.join(dirname, pattern)
+            self.assertEqual(sorted(glob.glob(pattern)), sorted(self.check.iglob(pattern)), pattern)
+
+    def test_max_files(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        for name in range(10):
+            open(path.join(dirname, str(name)), 'w').close()
+
+        conf = {
+            'init_config': {},
+            'instances': [
+                {'path': path.join(dirname, '*'), 'expect': 'present', 'max_files': 3}
+            ]
+        }
+        self.check = load_check('file', conf, {})
+
+        # gives up as soon as there are too many, without stat'ing the rest
+        with patch('os.stat', wraps=os.stat) as stat:
+            self.assertRaises(Exception, self.check.check, conf['instances'][0])
+        self.assertEqual(3, stat.call_count)
+
+        conf['instances'][0]['max_files'] = 10
+        self.check.check(conf['instances'][0])
+        service_checks = self.check.get_service_checks()
+        self.assertTrue(service_checks[0]['status'] == AgentCheck.OK)
+
+    def test_aggregate(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        conf = {
+            'init_config': {},
+            'instances': [
+                {'path': path.join(dirname, '*'), 'expect': 'absent', 'aggregate': True}
+            ]
+        }
+        self.check = load_check('file', conf, {})
+
+        self.check.check(conf['instances'][0])
+        metrics = dict((metric[0], metric[2]) for metric in self.check.get_metrics())
+        self.assertEqual({'file.age_seconds': -1, 'file.count': 0, 'file.newest_age_seconds': -1}, metrics)
+
+        ctimes = {'a': 300, 'b': 100, 'c': 200}
+        for name in ctimes:
+            open(path.join(dirname, name), 'w').close()
+
+        def fake_stat(filename):
+            return Mock(st_ctime=ctimes[path.basename(filename)])
+
+        with patch('os.stat', side_effect=fake_stat), patch('time.time', return_value=1000):
+            self.check.check(conf['instances'][0])
+        metrics = dict((metric[0], metric[2]) for metric in self.check.get_metrics())
+        self.assertEqual({'file.age_seconds': 900, 'file.count': 3, 'file.newest_age_seconds': 700}, metrics)
+
+    def test_inotify(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        open(path.join(dirname, 'a'), 'w').close()
+
+        conf = {
+            'init_config': {},
+            'instances': [
+                {'path': path.join(dirname, '*'), 'expect': 'present', 'aggregate': True, 'inotify': True}
+            ]
+        }
+        self.check = load_check('file', conf, {})
+        if self.check.watcher() is None:
+            self.skipTest("inotify isn't available")
+
+        def run():
+            with patch.object(self.check, 'scan_files', wraps=self.check.scan_files) as scan_files:
+                self.check.check(conf['instances'][0])
+            metrics = dict((metric[0], metric[2]) for metric in self.check.get_metrics())
+            return scan_files.call_count, metrics['file.count']
+
+        # looked through once, and not again until something changes
+        self.assertEqual((1, 1), run())
+        self.assertEqual((0, 1), run())
+
+        open(path.join(dirname, 'b'), 'w').close()
+        self.assertEqual((1, 2), run())
+        self.assertEqual((0, 2), run())
+
+        os.remove(path.join(dirname, 'a'))
+        self.assertEqual((1, 1), run())
+
+        # a directory replaced by another is watched in its place
+        shutil.rmtree(dirname)
+        self.assertEqual((1, 0), run())
+        os.mkdir(dirname)
+        open(path.join(dirname, 'c'), 'w').close()
+        self.assertEqual((1, 1), run())
+        self.assertEqual((0, 1), run())
+        open(path.join(dirname, 'd'), 'w').close()
+        self.assertEqual((1, 2), run())
+
+        # lost events (IN_Q_OVERFLOW) mean looking through everything again
+        with patch.object(self.check._inotify, 'read_events', return_value=[(-1, 0x4000, 0, '')]):
+            self.assertEqual((1, 2), run())
+
+    def test_inotify_unavailable(self):
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        conf = {
+            'init_config': {'inotify': True},
+            'instances': [
+                {'path': path.join(dirname, '*'), 'expect': 'absent'}
+            ]
+        }
+        self.check = load_check('file', conf, {})
+
+        # globs every run instead
+        with patch('inotify.Inotify', side_effect=OSError(errno.ENOSYS, 'Function not implemented')):
+            for _ in range(2):
+                with patch.object(self.check, 'scan_files', wraps=self.check.scan_files) as scan_files:
+                    self.check.check(conf['instances'][0])
+                self.assertEqual(1, scan_files.call_count)
+        service_checks = self.check.get_service_checks()
+        self.assertTrue(service_checks[0]['status'] == AgentCheck.OK)
@@ -1,13 +1,24 @@
-from os import path, getuid
-#from tempfile import mkstemp, gettempdir
+from os import path, getuid, remove, rename, utime
+import gzip
+import sys
+import time
+
+# Add lib/ to the import path:
+agent_lib_dir = path.join(path.dirname(path.realpath(__file__)), '../../../lib')
+sys.path.insert(1, agent_lib_dir)
+import kernel_log
+
+# 3p
+from mock import patch
 
 # project
 from checks import AgentCheck
 from tests.checks.common import AgentCheckTest, load_check
+from tests.log_files import LogFiles
 from unittest import skipIf
 from nose.tools import *
 
-class TestFileUnit(AgentCheckTest):
+class TestFileUnit(LogFiles, AgentCheckTest):
     CHECK_NAME = 'system.oom'
     FIXTURE_PATH = path.join(
         path.dirname(path.realpath(__file__)),
@@ -15,6 +26,43 @@ class TestFileUnit(AgentCheckTest):
         'oom'
     )
 
+    def fixture_lines(self, filename):
+        with open(path.join(self.FIXTURE_PATH, filename), 'rt') as fh:
+            return fh.readlines()
+
+    def make_rotated_logs(self, *logs):
+        """Writes kern.log and its rotations, newest first, returning the directory they're in"""
+        dirname = self.make_log_dir()
+
+        now = time.time()
+        for age, (filename, lines) in enumerate(logs):
+            filename = path.join(dirname, filename)
+            opener = gzip.open if filename.endswith('.gz') else open
+            with opener(filename, 'wb') as fh:
+                fh.writelines(lines)
+            utime(filename, (now - age * 3600, now - age * 3600))
+
+        return dirname
+
+    def run_and_assert(self, check, filename, count, status, message=None, **options):
+        instance = {
+            'logfile': filename,
+            'kernel_line_regex': '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+            'kill_message_regex': '^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child'
+        }
+        instance.update(options)
+        check.check(instance)
+
+        metrics = [metric for metric in check.get_metrics() if metric[0] == 'system.oom.count']
+        self.assertEqual(1, len(metrics))
+        self.assertEqual(count, metrics[0][2])
+
+        service_checks = check.get_service_checks()
+        self.assertEqual(1, len(service_checks))
+        self.assertEqual(status, service_checks[0].get('status'))
+        if message is not None:
+            self.assertRegexpMatches(service_checks[0].get('message'), message)
+
     def check_and_assert(self, filename, matches,
         kernel_line_regex='^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
         kill_message_regex='^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child'
@@ -126,3 +174,230 @@ class TestFileUnit(AgentCheckTest):
         self.check_and_assert('kern.rebooted.log', [
             { 'status': AgentCheck.CRITICAL, 'message': 'Process OOM killed' }
         ], kernel_line_regex='^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<nope>\d+(?:\.\d+)?)\] (?P<message>.*)$')
+
+    def test_incremental_appends(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+        filename = self.make_log(lines[:574])
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+
+        self.run_and_assert(check, filename, 0, AgentCheck.OK)
+
+        # a half-written line is left for the next run
+        self.append_log(filename, lines[574:602] + [lines[602][:60]])
+        self.run_and_assert(check, filename, 0, AgentCheck.OK)
+
+        self.append_log(filename, [lines[602][60:]] + lines[603:640])
+        self.run_and_assert(check, filename, 1, AgentCheck.CRITICAL, "'pid': '2089'")
+
+        self.append_log(filename, lines[640:688])
+        self.run_and_assert(check, filename, 2, AgentCheck.CRITICAL, "'pid': '2093'")
+
+        # nothing new
+        self.run_and_assert(check, filename, 2, AgentCheck.CRITICAL, "'pid': '2093'")
+
+        # the machine rebooted
+        self.append_log(filename, lines[688:])
+        self.run_and_assert(check, filename, 0, AgentCheck.OK)
+
+    def test_incremental_truncated(self):
+        lines = self.fixture_lines('kern.killed.log')
+        filename = self.make_log(lines)
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+
+        self.run_and_assert(check, filename, 2, AgentCheck.CRITICAL)
+
+        with open(filename, 'wt') as fh:
+            fh.writelines(lines[:574])
+        self.run_and_assert(check, filename, 0, AgentCheck.OK)
+
+    def test_incremental_rotated(self):
+        lines = self.fixture_lines('kern.killed.log')
+        filename = self.make_log(lines)
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+
+        self.run_and_assert(check, filename, 2, AgentCheck.CRITICAL)
+
+        # same size, different file
+        rotated = self.make_log(lines[:602] + [lines[602].replace('memory', 'mamory')] + lines[603:])
+        rename(rotated, filename)
+        self.run_and_assert(check, filename, 1, AgentCheck.CRITICAL, "'pid': '2093'")
+
+    def test_prefilter(self):
+        filename = self.make_log(self.fixture_lines('kern.rebooted.log'))
+        instance = {
+            'logfile': filename,
+            'kernel_line_regex': '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+            'kill_message_regex': '^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child'
+        }
+
+        # mostly kill and boot messages are run through the regexes, which is still enough to spot the reboot
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        check.check(instance)
+        metrics = dict((metric[0], metric[2]) for metric in check.get_metrics())
+        self.assertEqual(0, metrics['system.oom.count'])
+        self.assertTrue(metrics['system.oom.lines_scanned'] > 400)
+        self.assertTrue(metrics['system.oom.lines_regex_matched'] < metrics['system.oom.lines_scanned'] / 10)
+
+        # without a prefilter, the reboot is spotted just the same
+        instance['prefilter_substrings'] = []
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        check.check(instance)
+        metrics = dict((metric[0], metric[2]) for metric in check.get_metrics())
+        self.assertEqual(0, metrics['system.oom.count'])
+        self.assertEqual(metrics['system.oom.lines_scanned'], metrics['system.oom.lines_regex_matched'])
+
+    def test_prefilter_reboots(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+        without_boot_message = [line for line in lines if 'Linux version' not in line]
+        custom = {'prefilter_substrings': ['Out of memory']}
+
+        # the reboot is spotted from the uptimes of the lines ruled out, whichever the prefilter,
+        # and without the kernel's boot message
+        for log, options in [(lines, custom), (without_boot_message, {}), (without_boot_message, custom)]:
+            check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+            self.run_and_assert(check, self.make_log(log), 0, AgentCheck.OK, **options)
+
+            # the same reading the log as it's written
+            filename = self.make_log(log[:650])
+            check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+            self.run_and_assert(check, filename, 1, AgentCheck.CRITICAL, "'pid': '2089'", **options)
+            self.append_log(filename, log[650:])
+            self.run_and_assert(check, filename, 0, AgentCheck.OK, **options)
+
+            # and from rotated logs, read forwards
+            dirname = self.make_rotated_logs(
+                ('kern.log', log[1000:]),
+                ('kern.log.1', log[610:1000]),
+                ('kern.log.2.gz', log[:610]),
+            )
+            check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+            self.run_and_assert(check, path.join(dirname, 'kern.log'), 0, AgentCheck.OK,
+                                rotated_logfiles=path.join(dirname, 'kern.log.*'), **options)
+
+        # without uptimes in the regex, there's no telling
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, self.make_log(without_boot_message), 2, AgentCheck.CRITICAL,
+                            kernel_line_regex='^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<nope>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+                            **custom)
+
+    def test_rotated(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+        dirname = self.make_rotated_logs(
+            ('kern.log', lines[650:688]),
+            ('kern.log.1', lines[600:650]),
+            ('kern.log.2.gz', lines[:600]),
+        )
+        logfile = path.join(dirname, 'kern.log')
+
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, logfile, 1, AgentCheck.CRITICAL, "'pid': '2093'")
+
+        # both kills since the boot at the start of kern.log.2.gz are counted
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, logfile, 2, AgentCheck.CRITICAL, "'pid': '2093'",
+                            rotated_logfiles=logfile + '.*')
+
+    def test_rotated_latest(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+        dirname = self.make_rotated_logs(
+            ('kern.log', lines[620:650]),
+            ('kern.log.1.gz', lines[:620]),
+        )
+        logfile = path.join(dirname, 'kern.log')
+
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, logfile, 1, AgentCheck.CRITICAL, "'pid': '2089'",
+                            rotated_logfiles=logfile + '.*')
+
+    def test_rotated_rebooted(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+
+        # the reboot is at the start of kern.log
+        dirname = self.make_rotated_logs(
+            ('kern.log', lines[688:]),
+            ('kern.log.1', lines[:688]),
+        )
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, path.join(dirname, 'kern.log'), 0, AgentCheck.OK,
+                            rotated_logfiles=path.join(dirname, 'kern.log.*'))
+
+        # the reboot is in kern.log.1, after the first kill
+        dirname = self.make_rotated_logs(
+            ('kern.log', lines[1000:]),
+            ('kern.log.1', lines[610:1000]),
+            ('kern.log.2.gz', lines[:610]),
+        )
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+        self.run_and_assert(check, path.join(dirname, 'kern.log'), 0, AgentCheck.OK,
+                            rotated_logfiles=path.join(dirname, 'kern.log.*'))
+
+    def test_rotated_index(self):
+        lines = self.fixture_lines('kern.rebooted.log')
+        dirname = self.make_rotated_logs(
+            ('kern.log', lines[650:688]),
+            ('kern.log.1', lines[600:650]),
+            ('kern.log.2.gz', lines[:600]),
+        )
+        logfile = path.join(dirname, 'kern.log')
+        options = {
+            'rotated_logfiles': logfile + '*',
+            'rotated_index': path.join(dirname, 'kern.log.index'),
+        }
+
+        with patch.object(kernel_log, 'read_forward', wraps=kernel_log.read_forward) as read_forward:
+            check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+            self.run_and_assert(check, logfile, 2, AgentCheck.CRITICAL, "'pid': '2093'", **options)
+            self.assertEqual(2, read_forward.call_count)
+
+            # the rotated logs are only read once
+            self.append_log(logfile, lines[640:641])
+            self.run_and_assert(check, logfile, 2, AgentCheck.CRITICAL, "'pid': '2093'", **options)
+            self.assertEqual(2, read_forward.call_count)
+
+            # even by another process, which picks up the index the first left behind
+            kernel_log._indexes.clear()
+            check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+            self.run_and_assert(check, logfile, 2, AgentCheck.CRITICAL, "'pid': '2093'", **options)
+            self.assertEqual(2, read_forward.call_count)
+
+            # and again once compressed, as it's a new file
+            with open(path.join(dirname, 'kern.log.1'), 'rb') as src:
+                with gzip.open(path.join(dirname, 'kern.log.1.gz'), 'wb') as dst:
+                    dst.write(src.read())
+            remove(path.join(dirname, 'kern.log.1'))
+            self.run_and_assert(check, logfile, 2, AgentCheck.CRITICAL, "'pid': '2093'", **options)
+            self.assertEqual(3, read_forward.call_count)
+
+    def test_budget(self):
+        lines = self.fixture_lines('kern.killed.log')
+        filename = self.make_log(lines)
+        instance = {
+            'logfile': filename,
+            'kernel_line_regex': '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+            'kill_message_regex': '^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child',
+            'max_scan_bytes': 20000,
+        }
+        check = load_check('oom', {'init_config': {}, 'instances': []}, {})
+
+        # the log is read back to the boot a little at a time
+        counts = []
+        for run in range(10):
+            check.check(instance)
+            metrics = check.get_metrics()
+            check.get_service_checks()
+
+            scan_bytes = [metric[2] for metric in metrics if metric[0] == 'system.oom.scan_bytes']
+            self.assertTrue(scan_bytes[0] < 20000 + 1000)
+
+            count = [metric for metric in metrics if metric[0] == 'system.oom.count'][0]
+            counts.append((count[2], count[3]['tags']))
+            if not count[3]['tags']:
+                break
+
+        self.assertTrue(len(counts) > 2)
+        self.assertEqual((2, ['scan_truncated:true']), counts[0])
+        self.assertEqual((2, []), counts[-1])
+
+        # after which only new lines are read
+        self.append_log(filename, [lines[602].replace('490.357867', '600.000000')])
+        self.run_and_assert(check, filename, 3, AgentCheck.CRITICAL, "'pid': '2089'", max_scan_bytes=20000)
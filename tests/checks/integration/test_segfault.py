@@ -1,16 +1,17 @@
 from os import path, getuid
-#from tempfile import mkstemp, gettempdir
 
 # project
-from checks import AgentCheck
 from tests.checks.common import AgentCheckTest, load_check
+from tests.log_files import LogFiles
 from unittest import skipIf
 from nose.tools import *
 from datetime import datetime
 
-class TestFileUnit(AgentCheckTest):
+class TestFileUnit(LogFiles, AgentCheckTest):
     CHECK_NAME = 'system.segfault'
     METRIC_BASE = 'system.segfault'
+    SCAN_METRICS = ['system.segfault.lines_scanned', 'system.segfault.lines_regex_matched',
+                    'system.segfault.scan_bytes', 'system.segfault.scan_duration']
     FIXTURE_PATH = path.join(
         path.dirname(path.realpath(__file__)),
         'fixtures',
@@ -26,6 +27,8 @@ class TestFileUnit(AgentCheckTest):
         tags = [],
         # the timestamps in the fixture files are written generally leading up to this datetime
         mock_now = datetime(2018, 11, 29, 2, 12),
+        tail = False,
+        check = None,
     ):
         if filename[0] != '/':
             filename = path.join(self.FIXTURE_PATH, filename)
@@ -40,13 +43,14 @@ class TestFileUnit(AgentCheckTest):
                 'time_window_seconds': time_window_seconds,
                 'tags': tags,
                 'mock_now': mock_now,
+                'tail': tail,
             }]
         }
 
-        check = load_check('segfault', conf, {})
+        check = check or load_check('segfault', conf, {})
         check.check(conf['instances'][0])
 
-        received_metrics = sorted(check.get_metrics())
+        received_metrics = sorted(metric for metric in check.get_metrics() if metric[0] not in self.SCAN_METRICS)
 
         self.assertEqual(
             len(received_metrics),
@@ -155,3 +159,106 @@ class TestFileUnit(AgentCheckTest):
         self.check_and_assert('kern.envoy_segfaults.log', [
             { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:yovne', 'time_window:65'] }
         ], time_window_seconds=65, process_name_regex=None, tags=['process:yovne'])
+
+    def test_tail(self):
+        with open(path.join(self.FIXTURE_PATH, 'kern.multi_segfaults.log'), 'rt') as fh:
+            lines = fh.readlines()
+        filename = self.make_log(lines[:521])
+        check = load_check('segfault', {'init_config': {}, 'instances': []}, {})
+
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:envoy', 'time_window:7200'] }
+        ], time_window_seconds=7200, tail=True, check=check, mock_now=datetime(2018, 11, 29, 1, 0))
+
+        # a half-written line is left for the next run
+        self.append_log(filename, lines[521:522] + [lines[522][:60]])
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:anvoy', 'time_window:7200'] },
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:envoy', 'time_window:7200'] },
+        ], time_window_seconds=7200, tail=True, check=check, mock_now=datetime(2018, 11, 29, 2, 0))
+
+        self.append_log(filename, [lines[522][60:]] + lines[523:])
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:anvoy', 'time_window:7200'] },
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 3.0, 'tags': ['process:envoy', 'time_window:7200'] },
+        ], time_window_seconds=7200, tail=True, check=check)
+
+        # nothing new; the oldest segfaults slide out of the window
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 2.0, 'tags': ['process:envoy', 'time_window:7200'] },
+        ], time_window_seconds=7200, tail=True, check=check, mock_now=datetime(2018, 11, 29, 4, 5))
+
+        # truncated: start over
+        with open(filename, 'wt') as fh:
+            fh.writelines(lines[:520])
+        self.check_and_assert(filename, [], time_window_seconds=7200, tail=True, check=check)
+
+    def test_tail_new_instance(self):
+        with open(path.join(self.FIXTURE_PATH, 'kern.multi_segfaults.log'), 'rt') as fh:
+            lines = fh.readlines()
+        filename = self.make_log(lines[:521])
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:envoy', 'time_window:7200'] }
+        ], time_window_seconds=7200, tail=True, tags=['foo:bar'], mock_now=datetime(2018, 11, 29, 1, 0))
+
+        # a new instance of the check (say, the agent reloaded its config) carries on from
+        # where the last left off, and reports everything itself
+        self.append_log(filename, [lines[521].replace('Nov 29', 'Nov 99')])
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 1.0, 'tags': ['process:envoy', 'time_window:7200', 'foo:bar'] },
+            { 'name': 'system.segfault.errors', 'type': 'rate', 'value': 1, 'tags': ['type:parse', 'foo:bar'] },
+        ], time_window_seconds=7200, tail=True, tags=['foo:bar'], mock_now=datetime(2018, 11, 29, 1, 0))
+
+    def test_prefilter(self):
+        # substrings that rule out every segfault
+        self.check_and_assert('kern.envoy_segfaults.log', [], time_window_seconds=7200,
+            config={
+                'logfile': path.join(self.FIXTURE_PATH, 'kern.envoy_segfaults.log'),
+                'kernel_line_regex': '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+                'process_name_regex': '^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault',
+                'timestamp_format': '%b %d %H:%M:%S',
+                'time_window_seconds': 7200,
+                'mock_now': datetime(2018, 11, 29, 2, 12),
+                'prefilter_substrings': ['whaargarbl'],
+            })
+
+    def test_budget(self):
+        filename = path.join(self.FIXTURE_PATH, 'kern.multi_segfaults.log')
+        instance = {
+            'logfile': filename,
+            'kernel_line_regex': '^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$',
+            'process_name_regex': '^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault',
+            'timestamp_format': '%b %d %H:%M:%S',
+            'time_window_seconds': 7200,
+            'mock_now': datetime(2018, 11, 29, 2, 12),
+            'max_scan_bytes': 300,
+        }
+
+        # without tailing, what was found before running out is all there is
+        self.check_and_assert(filename, [
+            { 'name': 'system.segfault.count', 'type': 'gauge', 'value': 2.0, 'tags': ['process:envoy', 'scan_truncated:true', 'time_window:7200'] },
+        ], config=instance)
+
+        # tailing, the rest is read over the next few runs
+        filename = self.make_log(open(filename, 'rt').readlines())
+        instance.update(logfile=filename, tail=True, max_scan_bytes=2000)
+        check = load_check('segfault', {'init_config': {}, 'instances': []}, {})
+
+        for run in range(20):
+            check.check(instance)
+            metrics = check.get_metrics()
+
+            scan_bytes = [metric[2] for metric in metrics if metric[0] == 'system.segfault.scan_bytes']
+            self.assertTrue(scan_bytes[0] < 2000 + 200)
+
+            counts = [(metric[3]['tags'], metric[2]) for metric in metrics if metric[0] == 'system.segfault.count']
+            if not any('scan_truncated:true' in tags for tags, _ in counts):
+                break
+        else:
+            self.fail("Never finished reading the log")
+
+        self.assertTrue(run > 0)
+        self.assertEqual([
+            (['process:anvoy', 'time_window:7200'], 1.0),
+            (['process:envoy', 'time_window:7200'], 3.0),
+        ], sorted((sorted(tags), value) for tags, value in counts))
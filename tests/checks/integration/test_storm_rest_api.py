@@ -1,7 +1,50 @@
+# stdlib
+from os import path
+from tempfile import NamedTemporaryFile
+import sys
+import time
+
+# Add lib/ to the import path:
+agent_lib_dir = path.join(path.dirname(path.realpath(__file__)), '../../../lib')
+sys.path.insert(1, agent_lib_dir)
+import storm_utils
+
 # project
 from checks import AgentCheck
 from tests.checks.common import AgentCheckTest, load_check
 
+def cached_topology(name, updated, executors=1, **extra):
+    """A topology's entry in the cache, with one bolt that has its executor details cached"""
+    topology = {
+        'name': name,
+        'topology_id': name + '_v1-1-1464117779',
+        'status': 'success',
+        'updated': updated,
+        'topology': {
+            'spouts': [],
+            'bolts': [
+                {"executors": 3, "emitted": 10, "transferred": 12, "acked": 9, "executeLatency": "2.300", "tasks": 4, "executed": 12, "processLatency": "2.501", "boltId": "bolt", "capacity": "0.020", "failed": 2, "encodedBoltId": "bolt"},
+            ],
+        },
+        'component_details': [{
+            'id': 'bolt',
+            'status': 'success',
+            'updated': updated,
+            'details': {
+                'id': 'bolt',
+                'name': name + '_v1',
+                'componentType': 'bolt',
+                'executors': executors,
+                'executorStats': [
+                    {"emitted": 1, "port": 6700 + i, "transferred": 1, "host": "10.0.0.%d" % (i % 2), "acked": 1, "uptime": "4m 0s", "executeLatency": "0.5", "executed": 15, "processLatency": "0.25", "capacity": "0.%d" % i, "id": "[%d-%d]" % (i, i), "failed": 0}
+                    for i in range(executors)
+                ],
+            },
+        }],
+    }
+    topology.update(extra)
+    return topology
+
 class TestFileUnit(AgentCheckTest):
     CHECK_NAME='storm_rest_api'
 
@@ -419,3 +462,160 @@ class TestFileUnit(AgentCheckTest):
         executor_count = self.find_metric(metrics, 'storm.rest.executor.executors_total')
         self.assertEqual(72, executor_count[2])
         self.assert_tags(['storm_task_id:detail::spout:1234', 'storm_component_type:spout', 'storm_topology:a_topology', 'is_a_great_spout:true'], executor_count[3]['tags'])
+
+    def run_cached(self, topology_details, cache_format='json', **options):
+        """Runs the check over a cache of `topology_details`, returning the metrics and service checks"""
+        now = time.time()
+        cache = {
+            'status': 'success',
+            'updated': now,
+            'data': {
+                'cluster': {"supervisors": 1, "slotsTotal": 1, "slotsUsed": 1, "slotsFree": 0, "executorsTotal": 1, "tasksTotal": 1},
+                'supervisors': {'supervisors': []},
+                'topologies': {},
+                'topology_details': topology_details,
+            },
+        }
+        with NamedTemporaryFile() as cache_file:
+            storm_utils.dump_cache(cache, cache_file, cache_format)
+            cache_file.flush()
+            instance = {'url': 'http://localhost:8080', 'topologies': '^(.*)_v1$', 'cache_file': cache_file.name}
+            instance.update(options)
+            self.check = load_check('storm_rest_api', {'init_config': {}, 'instances': [instance]}, {})
+            self.check.check(instance)
+        return self.check.get_metrics(), self.check.get_service_checks()
+
+    def test_cached_topology_freshness(self):
+        now = time.time()
+        metrics, service_checks = self.run_cached([
+            cached_topology('fresh', now - 10),
+            cached_topology('stale', now - 1000),
+            cached_topology('failing', now - 20, status='error', error_url='http://localhost:8080/api/v1/topology/failing', error_timeout=5),
+        ])
+
+        # everything but the stale topology is reported
+        def topologies(name):
+            return set(tag for metric in metrics if metric[0] == name for tag in metric[3]['tags'] if tag.startswith('storm_topology:'))
+        self.assertEqual(set(['storm_topology:fresh', 'storm_topology:failing']), topologies('storm.rest.bolt.executors_total'))
+        self.assertEqual(set(['storm_topology:fresh', 'storm_topology:failing']), topologies('storm.rest.executor.executors_total'))
+
+        # with how old each is
+        for name, age in [('fresh', 10), ('stale', 1000), ('failing', 20)]:
+            metric = self.find_metric(metrics, 'storm.rest.topology.cache_age_seconds', ['storm_topology:' + name])
+            self.assertAlmostEqual(age, metric[2], delta=5)
+
+        statuses = dict(
+            (next(tag for tag in check['tags'] if tag.startswith('storm_topology:')), check['status'])
+            for check in service_checks if check['check'] == 'storm.rest.topology.cached_data_ok'
+        )
+        self.assertEqual({
+            'storm_topology:fresh': AgentCheck.OK,
+            'storm_topology:stale': AgentCheck.CRITICAL,
+            'storm_topology:failing': AgentCheck.WARNING,
+        }, statuses)
+        self.assertEqual(AgentCheck.OK, next(check for check in service_checks if check['check'] == 'storm.rest.cached_data_ok')['status'])
+
+    def test_cached_lines(self):
+        now = time.time()
+        topologies = [cached_topology('fresh', now - 10), cached_topology('stale', now - 1000)]
+        def rounded(metrics):
+            return sorted((name, round(value), attributes['tags']) for name, _, value, attributes in metrics)
+
+        json_metrics, json_service_checks = self.run_cached(topologies)
+        lines_metrics, lines_service_checks = self.run_cached(topologies, cache_format='lines')
+        self.assertEqual(rounded(json_metrics), rounded(lines_metrics))
+        self.assertEqual(json_service_checks, lines_service_checks)
+
+    def test_cached_component_freshness(self):
+        now = time.time()
+        topology = cached_topology('topo', now)
+        topology['component_details'][0]['updated'] = now - 1000
+        metrics, service_checks = self.run_cached([topology])
+
+        self.assertEqual([], [metric for metric in metrics if metric[0].startswith('storm.rest.executor.')])
+        self.find_metric(metrics, 'storm.rest.bolt.executors_total', ['storm_topology:topo'])
+        status = next(check for check in service_checks if check['check'] == 'storm.rest.topology.cached_data_ok')
+        self.assertEqual(AgentCheck.WARNING, status['status'])
+
+    def test_cached_without_freshness(self):
+        # caches from before topologies had their own times: everything is as fresh as the cache
+        topology = cached_topology('topo', 0)
+        for key in ['topology_id', 'status', 'updated']:
+            del topology[key]
+        topology['component_details'] = [topology['component_details'][0]['details']]
+        metrics, service_checks = self.run_cached([topology])
+
+        self.find_metric(metrics, 'storm.rest.executor.executors_total', ['storm_topology:topo'])
+        self.assertTrue(self.find_metric(metrics, 'storm.rest.topology.cache_age_seconds', ['storm_topology:topo'])[2] < 5)
+
+    def test_cached_tags(self):
+        now = time.time()
+        metrics, _ = self.run_cached(
+            [cached_topology('topo', now, executors=3)], metric_prefix='pre', tags=['cluster:one'],
+            task_tags={'bolt': {'bolt': ['is_a_great_bolt:true']}})
+
+        # a component's tags are the same for it and its executors, which add their own
+        component_tags = ['cluster:one', 'is_a_great_bolt:true', 'storm_topology:topo', 'storm_component_type:bolt', 'storm_task_id:bolt']
+        self.assertEqual(sorted(component_tags), sorted(self.find_metric(metrics, 'pre.storm.rest.bolt.executors_total')[3]['tags']))
+        self.assertEqual(sorted(component_tags), sorted(self.find_metric(metrics, 'pre.storm.rest.executor.executors_total')[3]['tags']))
+        for i in range(3):
+            self.assertEqual(
+                sorted(component_tags + ['executor_id:[%d-%d]' % (i, i), 'storm_host:10.0.0.%d' % (i % 2), 'storm_port:%d' % (6700 + i)]),
+                sorted(self.find_metric(metrics, 'pre.storm.rest.executor.capacity_percent', ['executor_id:[%d-%d]' % (i, i)])[3]['tags']))
+
+    def test_executor_metrics_by_host(self):
+        now = time.time()
+        topology = cached_topology('topo', now, executors=5)
+        for executor_metrics in ['raw', 'host', 'both']:
+            metrics, _ = self.run_cached([topology], executor_metrics=executor_metrics)
+            per_executor = [metric for metric in metrics if metric[0].startswith('storm.rest.executor.') and
+                            any(tag.startswith('executor_id:') for tag in metric[3]['tags'])]
+            per_host = [metric for metric in metrics if metric[0].startswith('storm.rest.executor_host.')]
+            # counters are only reported from the second run on
+            self.assertEqual(executor_metrics != 'host', len(per_executor) == 5 * 4)
+            self.assertEqual(executor_metrics != 'raw', len(per_host) == 2 * 8)
+
+        # executors 0, 2 and 4 are on 10.0.0.0, 1 and 3 on 10.0.0.1
+        def host_metric(name, host):
+            return self.find_metric(metrics, 'storm.rest.executor_host.' + name, ['storm_host:10.0.0.%d' % host])[2]
+        self.assertEqual(3, host_metric('executors_total', 0))
+        self.assertEqual(2, host_metric('executors_total', 1))
+        self.assertAlmostEqual(40, host_metric('capacity_percent.max', 0))
+        self.assertAlmostEqual(20, host_metric('capacity_percent.avg', 0))
+        self.assertAlmostEqual(20, host_metric('capacity_percent.avg', 1))
+        self.assertAlmostEqual(0.5, host_metric('execute_latency_us.max', 1))
+        self.assertEqual(240, host_metric('uptime_seconds.min', 1))
+        self.assertTrue(all('storm_task_id:bolt' in metric[3]['tags'] and not any(tag.startswith('storm_port:') for tag in metric[3]['tags'])
+                            for metric in per_host))
+
+        # counters are summed across a host's executors, counting on from the last run
+        config = self.check.instance_config(self.check.instances[0])
+        details = topology['component_details'][0]['details']
+        for i, executor in enumerate(details['executorStats']):
+            executor['emitted'] += i
+        self.check.report_executor_details(config, details)
+        metrics = self.check.get_metrics()
+        self.assertEqual(0 + 2 + 4, host_metric('emitted_total', 0))
+        self.assertEqual(1 + 3, host_metric('emitted_total', 1))
+        self.assertEqual('count', self.find_metric(metrics, 'storm.rest.executor_host.emitted_total', ['storm_host:10.0.0.0'])[3]['type'])
+
+        # an executor moving to another host brings what it's done since, not all it ever did
+        moved = details['executorStats'][4]
+        moved['host'] = '10.0.0.1'
+        moved['emitted'] += 10
+        details['executorStats'][0]['emitted'] += 1
+        self.check.report_executor_details(config, details)
+        metrics = self.check.get_metrics()
+        self.assertEqual(1, host_metric('emitted_total', 0))
+        self.assertEqual(10, host_metric('emitted_total', 1))
+        self.assertEqual(3, host_metric('executors_total', 1))
+
+        # and one restarting only has its own count start over
+        self.assertEqual(1 + 2, details['executorStats'][2]['emitted'])
+        details['executorStats'][2]['emitted'] = 2
+        details['executorStats'][0]['emitted'] += 3
+        moved['emitted'] += 5
+        self.check.report_executor_details(config, details)
+        metrics = self.check.get_metrics()
+        self.assertEqual(3 + 2, host_metric('emitted_total', 0))
+        self.assertEqual(5, host_metric('emitted_total', 1))
@@ -0,0 +1,264 @@
+from os import path
+from tempfile import mkdtemp
+import json
+import os
+import shutil
+
+# 3p
+from mock import patch
+from scandir import scandir
+
+# project
+from tests.checks.common import AgentCheckTest, load_check
+
+# file -> size, under the directory the check looks at
+TREE = {
+    'top.log': 1,
+    'kafka-0/a.log': 10,
+    'kafka-0/b.txt': 20,
+    'kafka-0/nested/c.log': 40,
+    'kafka-0/nested/deeper/d.log': 80,
+    'kafka-1/e.log': 160,
+    'other/f.log': 320,
+}
+
+class TestSubDirSizes(AgentCheckTest):
+    CHECK_NAME = 'subdir_sizes'
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name, size in TREE.iteritems():
+            filename = path.join(self.directory, name)
+            if not path.exists(path.dirname(filename)):
+                os.makedirs(path.dirname(filename))
+            with open(filename, 'w') as fh:
+                fh.write('x' * size)
+        os.mkdir(path.join(self.directory, 'empty'))
+
+    def collect(self, **options):
+        """
+        Returns {subdir tag: (files, bytes)}, keeping how long each took in self.durations
+        and all the metrics in self.metrics
+        """
+        instance = {'directory': self.directory}
+        instance.update(options)
+        self.check = load_check('subdir_sizes', {'init_config': {}, 'instances': [instance]}, {})
+        self.check.check(instance)
+
+        results = {}
+        self.durations = {}
+        self.metrics = self.check.get_metrics()
+        for name, _, value, attributes in self.metrics:
+            subdir = ','.join(sorted(tag for tag in attributes['tags'] if not tag.startswith('name:')))
+            files, size = results.get(subdir, (None, None))
+            if name == 'system.sub_dir.files':
+                files = value
+            elif name == 'system.sub_dir.bytes':
+                size = value
+            else:
+                if name == 'system.sub_dir.walk_duration':
+                    self.durations[subdir] = value
+                continue
+            results[subdir] = (files, size)
+        return results
+
+    def test_sizes(self):
+        self.assertEqual({
+            'subdir:kafka-0': (2, 30),
+            'subdir:kafka-1': (1, 160),
+            'subdir:other': (1, 320),
+            'subdir:empty': (0, 0),
+        }, self.collect())
+
+        self.assertEqual({
+            'subdir:kafka-0': (4, 150),
+            'subdir:kafka-1': (1, 160),
+            'subdir:other': (1, 320),
+            'subdir:empty': (0, 0),
+        }, self.collect(recurse=True))
+
+    def test_pattern(self):
+        self.assertEqual({
+            'subdir:kafka-0': (3, 130),
+            'subdir:kafka-1': (1, 160),
+            'subdir:other': (1, 320),
+            'subdir:empty': (0, 0),
+        }, self.collect(recurse=True, pattern='*.log'))
+
+    def test_patterns(self):
+        # any of several patterns, less exclusions
+        self.assertEqual({
+            'subdir:kafka-0': (2, 100),
+            'subdir:kafka-1': (0, 0),
+            'subdir:other': (1, 320),
+            'subdir:empty': (0, 0),
+        }, self.collect(recurse=True, pattern=['[abf].*', '*.txt', 'd.log'], exclude='a.*'))
+
+        # patterns with a slash in them are matched against the whole path
+        self.assertEqual({
+            'subdir:kafka-0': (2, 120),
+            'subdir:kafka-1': (0, 0),
+            'subdir:other': (0, 0),
+            'subdir:empty': (0, 0),
+        }, self.collect(recurse=True, pattern='*/nested/*'))
+        self.assertEqual({
+            'subdir:kafka-0': (2, 30),
+            'subdir:kafka-1': (1, 160),
+            'subdir:other': (1, 320),
+            'subdir:empty': (0, 0),
+        }, self.collect(recurse=True, exclude=['*/nested/*']))
+
+    def test_subdirtagname_regex(self):
+        self.assertEqual({
+            'partition:0,topic:kafka': (4, 150),
+            'partition:1,topic:kafka': (1, 160),
+        }, self.collect(recurse=True, subdirtagname_regex='(?P<topic>.*)-(?P<partition>\\d+)'))
+
+    def test_walks_once(self):
+        import subdir_sizes
+
+        # each directory is listed once, and nothing below the subdirectories without recurse
+        with patch.object(subdir_sizes, 'scandir', wraps=scandir) as listed:
+            self.collect(recurse=True)
+        self.assertEqual(7, listed.call_count)
+
+        with patch.object(subdir_sizes, 'scandir', wraps=scandir) as listed:
+            self.collect()
+        self.assertEqual(5, listed.call_count)
+
+    def test_symlinks(self):
+        # reported, but not followed
+        os.symlink(path.join(self.directory, 'kafka-1'), path.join(self.directory, 'link'))
+        self.assertEqual((0, 0), self.collect(recurse=True)['subdir:link'])
+
+    def test_workers(self):
+        expected = self.collect(recurse=True)
+        self.assertEqual(expected, self.collect(recurse=True, workers=3))
+        self.assertEqual(expected, self.collect(recurse=True, workers=10))
+
+        # and how long each subdirectory took
+        self.assertEqual(sorted(expected), sorted(self.durations))
+        for duration in self.durations.itervalues():
+            self.assertTrue(duration >= 0)
+
+    def test_max_walk_seconds(self):
+        # out of time before anything is walked: every subdirectory's size is partial
+        self.assertEqual({
+            'subdir:kafka-0,walk_truncated:true': (0, 0),
+            'subdir:kafka-1,walk_truncated:true': (0, 0),
+            'subdir:other,walk_truncated:true': (0, 0),
+            'subdir:empty,walk_truncated:true': (0, 0),
+        }, self.collect(recurse=True, max_walk_seconds=1e-9))
+        self.assertEqual(1, len(self.check.get_warnings()))
+
+        self.assertEqual(self.collect(recurse=True), self.collect(recurse=True, max_walk_seconds=60))
+
+    def test_cache(self):
+        import subdir_sizes
+        cache = path.join(self.directory, 'cache.json')
+        os.mkdir(path.join(self.directory, 'kafka-1', '\xff'))
+        expected = self.collect(recurse=True, cache=cache)
+        self.assertEqual((1, 160), expected['subdir:kafka-1'])
+
+        # unchanged directories aren't listed again, even by a check starting afresh
+        with patch.object(subdir_sizes, 'scandir', wraps=scandir) as listed:
+            self.assertEqual(expected, self.collect(recurse=True, cache=cache))
+        self.assertEqual(1, listed.call_count)
+
+        # only the directory with something new in it is
+        with open(path.join(self.directory, 'kafka-0', 'nested', 'g.log'), 'w') as fh:
+            fh.write('x' * 640)
+        with patch.object(subdir_sizes, 'scandir', wraps=scandir) as listed:
+            self.assertEqual((5, 790), self.collect(recurse=True, cache=cache)['subdir:kafka-0'])
+        self.assertEqual(2, listed.call_count)
+
+        # files growing in place are only noticed on a full rescan
+        with open(path.join(self.directory, 'kafka-1', 'e.log'), 'a') as fh:
+            fh.write('x' * 1000)
+        self.assertEqual((1, 160), self.collect(recurse=True, cache=cache)['subdir:kafka-1'])
+        self.assertEqual((1, 1160), self.collect(recurse=True, cache=cache, full_rescan_seconds=0)['subdir:kafka-1'])
+
+        # nor is what was cached for another pattern used
+        self.assertEqual((0, 0), self.collect(recurse=True, cache=cache, pattern='*.txt')['subdir:kafka-1'])
+        self.assertEqual((1, 20), self.collect(recurse=True, cache=cache, pattern='*.txt')['subdir:kafka-0'])
+
+    def test_cache_save(self):
+        import subdir_sizes
+        elsewhere = mkdtemp()
+        self.addCleanup(shutil.rmtree, elsewhere)
+
+        # a relative path is written next to where it points, not in $TMPDIR
+        cwd = os.getcwd()
+        os.chdir(elsewhere)
+        try:
+            self.collect(recurse=True, cache='cache.json')
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(['cache.json'], os.listdir(elsewhere))
+
+        # and nothing's left behind if it can't be
+        with patch.object(subdir_sizes, 'rename', side_effect=OSError(18, 'Invalid cross-device link')):
+            with self.assertRaises(OSError):
+                self.collect(recurse=True, cache=path.join(elsewhere, 'other.json'))
+        self.assertEqual(['cache.json'], os.listdir(elsewhere))
+
+    def test_corrupt_cache(self):
+        cache = path.join(self.directory, 'cache.json')
+        expected = self.collect(recurse=True, cache=cache)
+        with open(cache, 'r') as fh:
+            stored = json.load(fh)
+
+        # whatever isn't as the check left it is listed again
+        directories = sorted(stored['directories'])
+        stored['directories'][directories[0]] = stored['directories'][directories[0]][:4]
+        stored['directories'][directories[1]] = None
+        stored['directories'][directories[2]][4] = 'children'
+        stored['directories'][directories[3]][0] = 'mtime'
+        stored['directories'][directories[4]][5] = [1, 'two']
+        stored['directories'][directories[5]][4] = [u'\u2603']
+        for contents in [stored, [stored], dict(stored, directories=[]), dict(stored, full_scan='never')]:
+            with open(cache, 'w') as fh:
+                json.dump(contents, fh)
+            self.assertEqual(expected, self.collect(recurse=True, cache=cache))
+
+        with open(cache, 'w') as fh:
+            fh.write(json.dumps(stored)[:100])
+        self.assertEqual(expected, self.collect(recurse=True, cache=cache))
+
+    def test_size_histogram(self):
+        self.collect(recurse=True, size_histogram=True)
+        histogram = dict(
+            ((metric[3]['tags'][1], metric[3]['tags'][2]), metric[2])
+            for metric in self.metrics if metric[0] == 'system.sub_dir.files_by_size'
+        )
+        # 10 and 20 bytes, 40, 80
+        self.assertEqual([0, 0, 0, 0, 1, 1, 1, 1], [histogram['subdir:kafka-0', 'size_lt:%d' % (1 << bucket)] for bucket in range(8)])
+        self.assertEqual(10, len([key for key in histogram if key[0] == 'subdir:other']))
+        self.assertEqual(1, histogram['subdir:other', 'size_lt:512'])
+        self.assertEqual(0, len([key for key in histogram if key[0] == 'subdir:empty']))
+
+        # the same from the cache
+        cache = path.join(self.directory, 'cache.json')
+        for _ in range(2):
+            self.collect(recurse=True, size_histogram=True, cache=cache)
+            self.assertEqual(histogram, dict(
+                ((metric[3]['tags'][1], metric[3]['tags'][2]), metric[2])
+                for metric in self.metrics if metric[0] == 'system.sub_dir.files_by_size'
+            ))
+
+    def test_top_directories(self):
+        for workers in [1, 3]:
+            self.collect(recurse=True, top_directories=3, workers=workers)
+            top = dict(
+                ((metric[0], metric[3]['tags'][-1]), metric[2])
+                for metric in self.metrics if metric[0].startswith('system.sub_dir.top.')
+            )
+            self.assertEqual({
+                ('system.sub_dir.top.bytes', 'path:%s' % path.join(self.directory, 'other')): 320,
+                ('system.sub_dir.top.files', 'path:%s' % path.join(self.directory, 'other')): 1,
+                ('system.sub_dir.top.bytes', 'path:%s' % path.join(self.directory, 'kafka-1')): 160,
+                ('system.sub_dir.top.files', 'path:%s' % path.join(self.directory, 'kafka-1')): 1,
+                ('system.sub_dir.top.bytes', 'path:%s' % path.join(self.directory, 'kafka-0', 'nested', 'deeper')): 80,
+                ('system.sub_dir.top.files', 'path:%s' % path.join(self.directory, 'kafka-0', 'nested', 'deeper')): 1,
+            }, top)
@@ -7,6 +7,7 @@ sys.path.insert(1, agent_lib_dir)
 # stdlib
 import re
 from datetime import datetime
+from tempfile import TemporaryFile
 
 # test
 import unittest
@@ -44,3 +45,120 @@ class TestHelpers(unittest.TestCase):
         dt_now = datetime(2018, 12, 31, 11, 59, 59)
         parsed = helpers.parse_fix_timestamp('2010-01-01 00:00:00', '%Y-%m-%d %H:%M:%S', dt_now)
         self.assertEqual(2010, parsed.year)
+
+    def test_parse_timestamp(self):
+        # the classic syslog format takes the fast path, which should agree with strptime
+        for timestamp in ['Jan  1 00:00:00', 'Jun  1 09:09:09', 'Sep 10 12:34:56', 'Dec 31 23:59:59']:
+            self.assertEqual(
+                datetime.strptime(timestamp, '%b %d %H:%M:%S'),
+                helpers.parse_timestamp(timestamp, '%b %d %H:%M:%S')
+            )
+
+        # unpadded days, and other formats, go through strptime
+        self.assertEqual(datetime(1900, 6, 1, 9, 9, 9), helpers.parse_timestamp('Jun 1 09:09:09', '%b %d %H:%M:%S'))
+        self.assertEqual(datetime(2010, 1, 1), helpers.parse_timestamp('2010-01-01 00:00:00', '%Y-%m-%d %H:%M:%S'))
+
+        # and fail the same way
+        for timestamp in ['Foo  1 09:09:09', 'Feb 30 09:09:09', 'Jun  1 25:09:09', 'garbage']:
+            with self.assertRaises(ValueError):
+                helpers.parse_timestamp(timestamp, '%b %d %H:%M:%S')
+        with self.assertRaises(TypeError):
+            helpers.parse_timestamp(None, '%b %d %H:%M:%S')
+
+    def test_compile_regex(self):
+        regex = helpers.compile_regex('^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault')
+        self.assertEqual('envoy', regex.match('envoy[12345]: segfault at b').group('process'))
+
+        # compiled once, and handed out again after that
+        self.assertTrue(regex is helpers.compile_regex('^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault'))
+        self.assertFalse(regex is helpers.compile_regex('^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault', re.IGNORECASE))
+
+        # bad patterns fail every time
+        for _ in range(2):
+            self.assertRaises(re.error, helpers.compile_regex, '(unbalanced')
+            self.assertRaises(TypeError, helpers.compile_regex, None)
+
+    def test_regex_literal(self):
+        self.assertEqual('Out of memory: Kill process ', helpers.regex_literal(
+            '^Out of memory: Kill process (?P<pid>\d+) \((?P<pname>.*?)\) score (?P<score>.*?) or sacrifice child'))
+        self.assertEqual(']: segfault', helpers.regex_literal('^(?P<process>[^\[]+)\[(?P<pid>\d+)\]: segfault'))
+        self.assertEqual('foo', helpers.regex_literal('^foo$'))
+
+        # nothing every match has to contain
+        self.assertEqual(None, helpers.regex_literal('foo|bar'))
+        self.assertEqual(None, helpers.regex_literal('(foo)*'))
+        self.assertEqual(None, helpers.regex_literal(''))
+
+    def test_line_prefilter(self):
+        self.assertTrue(helpers.line_prefilter([])('anything'))
+        self.assertTrue(helpers.line_prefilter(None)('anything'))
+
+        prefilter = helpers.line_prefilter(['segfault'])
+        self.assertTrue(prefilter('envoy[12345]: segfault at b'))
+        self.assertFalse(prefilter('envoy[12345]: SEGFAULT at b'))
+
+        prefilter = helpers.line_prefilter(['Out of memory', 'Linux version'], ignorecase=True)
+        self.assertTrue(prefilter('out of memory: Kill process 1'))
+        self.assertTrue(prefilter('Linux version 4.4.0-47-generic'))
+        self.assertFalse(prefilter('Initializing cgroup subsys cpu'))
+
+    def test_lru_cache(self):
+        calls = []
+
+        @helpers.lru_cache(maxsize=2)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual(2, double(1))
+        self.assertEqual(4, double(2))
+        self.assertEqual(2, double(1))
+        self.assertEqual([1, 2], calls)
+
+        # 2 is the least recently used
+        self.assertEqual(6, double(3))
+        self.assertEqual(2, double(1))
+        self.assertEqual(4, double(2))
+        self.assertEqual([1, 2, 3, 2], calls)
+
+    def test_chunked_reverse_readline(self):
+        def lines(contents, buf_size):
+            with TemporaryFile() as fh:
+                fh.write(contents)
+                fh.flush()
+                return list(helpers.chunked_reverse_readline(fh, buf_size))
+
+        for buf_size in [1, 4, 7, 8192]:
+            # empty files have no lines
+            self.assertEqual([], lines('', buf_size))
+            self.assertEqual([], lines('\n', buf_size))
+
+            # trailing newlines don't make for an empty last line
+            self.assertEqual(['two', 'one'], lines('one\ntwo\n', buf_size))
+            self.assertEqual(['two', 'one'], lines('one\ntwo', buf_size))
+
+            # blank lines are skipped
+            self.assertEqual(['three', 'one'], lines('\none\n\n\nthree\n', buf_size))
+
+            # lines longer than the chunk size
+            self.assertEqual(['ccccccccccc', 'b', 'aaaaaaaaaa'], lines('aaaaaaaaaa\nb\nccccccccccc\n', buf_size))
+
+            # same lines as reverse_readline
+            with TemporaryFile() as fh:
+                fh.write('Nov 28 22:00:27 host kernel: [ 0.000000] line %d\n' * 100 % tuple(range(100)))
+                fh.flush()
+                self.assertEqual(list(helpers.reverse_readline(fh, 8192)), list(helpers.chunked_reverse_readline(fh, buf_size)))
+
+            # only up to `end`
+            with TemporaryFile() as fh:
+                fh.write('one\ntwo\nthree\n')
+                fh.flush()
+                self.assertEqual(['two', 'one'], list(helpers.chunked_reverse_readline(fh, buf_size, end=8)))
+                self.assertEqual(['two', 'one'], list(helpers.reverse_readline(fh, buf_size, end=8)))
+
+            # where each line starts, so reading can be picked up again from there
+            with TemporaryFile() as fh:
+                fh.write('\none\n\n\nthree\nfour')
+                fh.flush()
+                self.assertEqual([(13, 'four'), (7, 'three'), (1, 'one')], list(helpers.chunked_reverse_readline(fh, buf_size, offsets=True)))
+                self.assertEqual([(1, 'one')], list(helpers.chunked_reverse_readline(fh, buf_size, end=7, offsets=True)))
@@ -0,0 +1,252 @@
+# Add lib/ to the import path:
+import sys
+import os
+agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../lib')
+sys.path.insert(1, agent_lib_dir)
+
+# stdlib
+import re
+
+# test
+import unittest
+from mock import patch
+from tests.log_files import LogFiles
+
+# unit under test
+import kernel_log
+
+KERNEL_LINE_REGEX = re.compile('^(?P<timestamp>.+?) (?P<host>\S+) kernel: \[\s*(?P<uptime>\d+(?:\.\d+)?)\] (?P<message>.*)$')
+
+class Recorder(object):
+    """A consumer remembering the messages it was handed"""
+
+    def __init__(self, substring, backward_lines=None):
+        self.substring = substring
+        self.backward_lines = backward_lines
+        self.resets = 0
+        self.backward = []
+        self.forward = []
+
+    def prefilter(self, line):
+        return self.substring in line
+
+    def reset(self):
+        self.resets += 1
+        self.backward = []
+        self.forward = []
+
+    def consume_backward(self, fields, candidate):
+        if candidate:
+            self.backward.append(fields['message'])
+        return self.backward_lines is not None and len(self.backward) >= self.backward_lines
+
+    def consume(self, records):
+        self.forward.extend(fields['message'] for fields in records)
+
+class UptimeRecorder(Recorder):
+    """A Recorder that's also handed the uptimes either side of reboots"""
+    uptimes = True
+
+    def reset(self):
+        Recorder.reset(self)
+        self.reboots = []
+
+    def consume_backward(self, fields, candidate):
+        if 'message' not in fields:
+            self.reboots.append(fields['uptime'])
+            return False
+        return Recorder.consume_backward(self, fields, candidate)
+
+    def consume(self, records):
+        self.reboots.extend(fields['uptime'] for fields in records if 'message' not in fields)
+        Recorder.consume(self, [fields for fields in records if 'message' in fields])
+
+def line(uptime, message):
+    return 'Nov 28 22:00:27 host kernel: [%12.6f] %s\n' % (uptime, message)
+
+class TestKernelLog(LogFiles, unittest.TestCase):
+    def setUp(self):
+        self.logfile = self.make_log([line(1, 'apple 1'), line(2, 'banana 1'), line(3, 'apple 2')])
+
+    def append(self, *lines):
+        self.append_log(self.logfile, lines)
+
+    def test_scanner_is_shared(self):
+        scanner = kernel_log.scanner(self.logfile, KERNEL_LINE_REGEX)
+        self.assertTrue(scanner is kernel_log.scanner(self.logfile, re.compile(KERNEL_LINE_REGEX.pattern)))
+        self.assertFalse(scanner is kernel_log.scanner(self.logfile, re.compile('^(?P<message>.*)$')))
+
+    def test_scan(self):
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        apples = scanner.consumer('apples', lambda: Recorder('apple'))
+        bananas = scanner.consumer('bananas', lambda: Recorder('banana'))
+        self.assertTrue(apples is scanner.consumer('apples', lambda: Recorder('nope')))
+
+        # everyone reads backwards first
+        scanner.scan()
+        self.assertEqual(['apple 2', 'apple 1'], apples.backward)
+        self.assertEqual(['banana 1'], bananas.backward)
+        self.assertEqual(3, scanner.lines_scanned)
+        self.assertEqual(3, scanner.lines_regex_matched)
+
+        # then only appended lines are read, once for everyone
+        self.append(line(4, 'apple 3'), line(5, 'cherry 1'), line(6, 'banana 2'))
+        scanner.scan()
+        self.assertEqual(['apple 3'], apples.forward)
+        self.assertEqual(['banana 2'], bananas.forward)
+        self.assertEqual(3, scanner.lines_scanned)
+        self.assertEqual(2, scanner.lines_regex_matched)
+
+        # nothing changed, so there's nothing to do
+        scanner.scan()
+        self.assertEqual(0, scanner.lines_scanned)
+        self.assertEqual(['apple 3'], apples.forward)
+
+        # latecomers read backwards from where everyone else has got to
+        cherries = scanner.consumer('cherries', lambda: Recorder('cherry'))
+        self.append(line(7, 'cherry 2'))
+        scanner.scan()
+        self.assertEqual(['cherry 1'], cherries.backward)
+        self.assertEqual(['cherry 2'], cherries.forward)
+        self.assertEqual(1, apples.resets)
+
+    def test_scan_stops_reading_backwards(self):
+        self.append(*[line(4 + i, 'filler') for i in range(200)])
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        apples = scanner.consumer('apples', lambda: Recorder('apple', backward_lines=1))
+
+        scanner.scan()
+        self.assertEqual(['apple 2'], apples.backward)
+        self.assertEqual(201, scanner.lines_scanned)
+        # one in every SAMPLE_LINES lines nobody wants is parsed anyway
+        self.assertEqual(1 + 200 // kernel_log.SAMPLE_LINES, scanner.lines_regex_matched)
+
+    def test_line_uptime(self):
+        self.assertEqual(12.5, kernel_log.line_uptime(line(12.5, 'apple')))
+        self.assertEqual(None, kernel_log.line_uptime('Nov 28 22:00:27 host kernel: envoy[1234]: segfault'))
+        self.assertEqual(None, kernel_log.line_uptime('Nov 28 22:00:27 host kernel: [ nope.] apple'))
+        self.assertEqual(None, kernel_log.line_uptime('Nov 28 22:00:27 host kernel: [ 12.5'))
+
+    def test_scan_uptimes(self):
+        # rebooted between banana 1 and 2, with nothing the prefilter wants either side
+        self.append(*[line(4 + i, 'filler') for i in range(10)] + [line(0.5, 'filler'), line(1, 'banana 2')])
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        bananas = scanner.consumer('bananas', lambda: UptimeRecorder('banana'))
+        apples = scanner.consumer('apples', lambda: Recorder('apple'))
+
+        scanner.scan()
+        self.assertEqual([0.5, 13], bananas.reboots)
+        self.assertEqual(['banana 2', 'banana 1'], bananas.backward)
+        self.assertEqual(['apple 2', 'apple 1'], apples.backward)
+
+        self.append(line(2, 'filler'), line(0.25, 'filler'))
+        scanner.scan()
+        self.assertEqual([0.5, 13, 2, 0.25], bananas.reboots)
+        self.assertEqual([], apples.forward)
+
+        # not without an uptime in the regex
+        scanner = kernel_log.KernelLogScanner(self.logfile, re.compile(KERNEL_LINE_REGEX.pattern.replace('uptime', 'nope')))
+        bananas = scanner.consumer('bananas', lambda: UptimeRecorder('banana'))
+        scanner.scan()
+        self.assertEqual([], bananas.reboots)
+
+    def test_scan_partial_line(self):
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        apples = scanner.consumer('apples', lambda: Recorder('apple'))
+        scanner.scan()
+
+        partial = line(4, 'apple 3')
+        self.append(partial[:20])
+        scanner.scan()
+        self.assertEqual([], apples.forward)
+
+        self.append(partial[20:])
+        scanner.scan()
+        self.assertEqual(['apple 3'], apples.forward)
+
+    def test_scan_rotated(self):
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        apples = scanner.consumer('apples', lambda: Recorder('apple'))
+        scanner.scan()
+
+        # truncated
+        with open(self.logfile, 'wt') as fh:
+            fh.write(line(1, 'apple 10'))
+        scanner.scan()
+        self.assertEqual(2, apples.resets)
+        self.assertEqual(['apple 10'], apples.backward)
+
+        # replaced
+        rotated = self.make_log([line(1, 'apple 20'), line(2, 'apple 21')])
+        os.rename(rotated, self.logfile)
+        scanner.scan()
+        self.assertEqual(3, apples.resets)
+        self.assertEqual(['apple 21', 'apple 20'], apples.backward)
+
+    def test_scan_budget(self):
+        self.append(*[line(4 + i, 'filler') for i in range(200)])
+        scanner = kernel_log.KernelLogScanner(self.logfile, KERNEL_LINE_REGEX)
+        apples = scanner.consumer('apples', lambda: Recorder('apple'))
+
+        scanner.scan(kernel_log.Budget(max_bytes=1000))
+        self.assertTrue(scanner.truncated)
+        self.assertTrue(scanner.budget.bytes < 1000 + len(line(0, 'filler')))
+        self.assertEqual([], apples.backward)
+
+        # lines appended since are read first, then reading backwards carries on
+        self.append(line(300, 'apple 3'))
+        while scanner.truncated:
+            scanner.scan(kernel_log.Budget(max_bytes=1000))
+            self.assertEqual(['apple 3'], apples.forward)
+        self.assertEqual(['apple 2', 'apple 1'], apples.backward)
+        self.assertEqual(1, apples.resets)
+
+        # once caught up, the log is left alone until it changes
+        scanner.scan(kernel_log.Budget(max_bytes=1000))
+        self.assertFalse(scanner.truncated)
+        self.assertEqual(0, scanner.lines_scanned)
+
+    def test_budget(self):
+        budget = kernel_log.Budget(max_bytes=100)
+        self.assertFalse(budget.spend(60))
+        self.assertTrue(budget.spend(60))
+        self.assertEqual(120, budget.bytes)
+
+        # the clock is only looked at now and then
+        budget = kernel_log.Budget(max_seconds=0)
+        for _ in range(kernel_log.Budget.CLOCK_LINES - 1):
+            self.assertFalse(budget.spend(1))
+        self.assertTrue(budget.spend(1))
+
+        budget = kernel_log.Budget()
+        for _ in range(kernel_log.Budget.CLOCK_LINES * 2):
+            self.assertFalse(budget.spend(1 << 20))
+
+    def test_scan_missing(self):
+        scanner = kernel_log.KernelLogScanner(self.logfile + '.nonexistent', KERNEL_LINE_REGEX)
+        scanner.consumer('apples', lambda: Recorder('apple'))
+        with self.assertRaises(IOError):
+            scanner.scan()
+
+    def test_index_save(self):
+        dirname = self.make_log_dir()
+        index = kernel_log.RotatedLogIndex(os.path.join(dirname, 'index.json'), 'signature')
+        index.summary(self.logfile, lambda logfile: {'lines': 3})
+        self.assertEqual(['index.json'], os.listdir(dirname))
+        self.assertEqual(index.summaries, kernel_log.RotatedLogIndex(index.path, 'signature').summaries)
+
+        # a relative path is written next to where it points, not in $TMPDIR
+        cwd = os.getcwd()
+        os.chdir(dirname)
+        try:
+            relative = kernel_log.RotatedLogIndex('relative.json', 'signature')
+            relative.summary(self.logfile, lambda logfile: {'lines': 3})
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(['index.json', 'relative.json'], sorted(os.listdir(dirname)))
+
+        # and nothing's left behind if it can't be
+        with patch.object(kernel_log.os, 'rename', side_effect=OSError(18, 'Invalid cross-device link')):
+            with self.assertRaises(OSError):
+                index.prune([])
+        self.assertEqual(['index.json', 'relative.json'], sorted(os.listdir(dirname)))
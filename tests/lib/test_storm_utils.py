@@ -5,10 +5,15 @@ agent_lib_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../..
 sys.path.insert(1, agent_lib_dir)
 
 # stdlib
+from tempfile import NamedTemporaryFile
+import json
+import random
 import re
 
 # test
 import unittest
+from mock import patch
+from tests.storm_timespecs import random_timespec, split_timespec
 
 # unit under test
 import storm_utils
@@ -23,7 +28,27 @@ class TestStormUtils(unittest.TestCase):
             storm_utils.translate_timespec('20--')
         with self.assertRaises(ValueError) as context:
             storm_utils.translate_timespec('20Y 5m 3s')
+        with self.assertRaises(ValueError) as context:
+            storm_utils.translate_timespec('5m20s')
+        self.assertEqual(330, storm_utils.translate_timespec('  5m  30s '))
+        self.assertEqual(4, storm_utils.translate_timespec('4s'))
+
+        # the same as parsing a component at a time, cached or not
+        rng = random.Random(0)
+        for _ in range(1000):
+            timespec = random_timespec(rng)
+            self.assertEqual(split_timespec(timespec), storm_utils.translate_timespec(timespec))
+            self.assertEqual(split_timespec(timespec), storm_utils.translate_timespec(timespec))
 
+    def test_timespec_cache(self):
+        # a component's executors: thousands of them, started within a few seconds of each other
+        uptimes = ['3d 4h 12m %ds' % (i % 5) for i in range(5000)]
+        storm_utils.translate_timespec.cache_clear()
+        with patch.object(storm_utils, 'TIMESPEC_RE', wraps=storm_utils.TIMESPEC_RE) as timespec_re:
+            parsed = map(storm_utils.translate_timespec, uptimes)
+        self.assertEqual([((3*24 + 4)*60 + 12)*60 + i % 5 for i in range(5000)], parsed)
+        # each different uptime is only parsed once
+        self.assertEqual(5, timespec_re.match.call_count)
 
     def test_collect_topologies(self):
         topologies_re = re.compile('^(sometopo)_.*$')
@@ -39,3 +64,90 @@ class TestStormUtils(unittest.TestCase):
         # the interesting one:
         topo = collected_topos.get('sometopo')
         self.assertEqual(topo['id'], 'sometopo_987IENien9887a-3-1464117779')
+        self.assertEqual(['sometopo'], sorted(collected_topos))
+
+        # each uptime is parsed once, and the first of the youngest wins
+        topologies['topologies'].append(dict(topologies['topologies'][1], id='sometopo_later'))
+        with patch.object(storm_utils, 'translate_timespec', wraps=storm_utils.translate_timespec) as translate:
+            collected_topos = storm_utils.collect_topologies(topologies_re, topologies['topologies'])
+        self.assertEqual(3, translate.call_count)
+        self.assertEqual(collected_topos['sometopo']['id'], 'sometopo_987IENien9887a-3-1464117779')
+
+    def test_cache_formats(self):
+        cached = {
+            'status': 'success',
+            'updated': 1000.5,
+            'data': {
+                'cluster': {'supervisors': 7},
+                'topology_details': [
+                    {'name': 'one', 'updated': 1000.5, 'topology': {'bolts': []}},
+                    {'name': 'two', 'updated': 999.25, 'topology': {'bolts': [{'boltId': 'b\tc\nd'}]}},
+                ],
+            },
+        }
+        errored = {'status': 'error', 'error_url': 'http://localhost:8080', 'error_timeout': 5, 'updated': 1001.5}
+
+        for cache_format in ['json', 'lines']:
+            for contents in [cached, errored]:
+                with NamedTemporaryFile() as fh:
+                    storm_utils.dump_cache(contents, fh, cache_format)
+                    fh.flush()
+                    read = storm_utils.CacheReader(fh.name).read()
+                    read.pop('format', None)
+                    self.assertEqual(contents, read)
+
+        with self.assertRaises(ValueError):
+            storm_utils.dump_cache(cached, None, 'msgpack')
+
+    def test_cache_reader(self):
+        cached = {
+            'status': 'success',
+            'updated': 1000.5,
+            'data': {
+                'topology_details': [{'name': name, 'updated': 1000.5} for name in ['one', 'two', 'three']],
+            },
+        }
+
+        def write(path):
+            with open(path, 'w') as fh:
+                storm_utils.dump_cache(cached, fh, 'lines')
+
+        with NamedTemporaryFile() as fh:
+            write(fh.name)
+            reader = storm_utils.CacheReader(fh.name)
+            with patch.object(storm_utils.json, 'loads', wraps=json.loads) as loads:
+                reader.read()
+                self.assertEqual(4, loads.call_count)
+
+                # unchanged: not even read again
+                loads.reset_mock()
+                self.assertEqual(['one', 'two', 'three'], [t['name'] for t in reader.read()['data']['topology_details']])
+                self.assertEqual(0, loads.call_count)
+
+                # only what's changed is parsed
+                loads.reset_mock()
+                cached['updated'] = 1060.5
+                cached['data']['topology_details'][1]['status'] = 'error'
+                del cached['data']['topology_details'][2]
+                write(fh.name)
+                os.utime(fh.name, (0, 0))
+                read = reader.read()
+                self.assertEqual(2, loads.call_count)
+                self.assertEqual(1060.5, read['updated'])
+                self.assertEqual([None, 'error'], [t.get('status') for t in read['data']['topology_details']])
+
+                # which doesn't include being fetched again
+                loads.reset_mock()
+                cached['data']['topology_details'][0]['updated'] = 1120.5
+                cached['data']['topology_details'][1]['component_details'] = [{'id': 'bolt', 'updated': 1120.25}]
+                write(fh.name)
+                os.utime(fh.name, (1, 1))
+                read = reader.read()
+                self.assertEqual(2, loads.call_count)
+                self.assertEqual([1120.5, 1000.5], [t['updated'] for t in read['data']['topology_details']])
+                cached['data']['topology_details'][1]['component_details'][0]['updated'] = 1180.25
+                write(fh.name)
+                os.utime(fh.name, (2, 2))
+                read = reader.read()
+                self.assertEqual(3, loads.call_count)
+                self.assertEqual(cached['data']['topology_details'], read['data']['topology_details'])
@@ -0,0 +1,31 @@
+from os import path, remove
+from tempfile import mkdtemp, mkstemp
+import shutil
+
+
+class LogFiles(object):
+    """
+    A TestCase mixin for tests that write logs: the files and directories made are
+    removed once the test is done, even if it moved them around
+    """
+
+    def make_log(self, lines=[]):
+        """Writes `lines` to a new log file, returning its name"""
+        _, filename = mkstemp()
+        self.addCleanup(self._remove_log, filename)
+        self.append_log(filename, lines)
+        return filename
+
+    def append_log(self, filename, lines):
+        with open(filename, 'at') as fh:
+            fh.writelines(lines)
+
+    def make_log_dir(self):
+        """Makes a directory to put logs in, returning its name"""
+        dirname = mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname, True)
+        return dirname
+
+    def _remove_log(self, filename):
+        if path.exists(filename):
+            remove(filename)
@@ -0,0 +1,403 @@
+# stdlib
+from os import path
+import os
+from tempfile import mkdtemp
+import imp
+import runpy
+import shutil
+import sys
+import threading
+import time
+import urlparse
+
+# 3p
+from mock import patch
+import yaml
+
+# script under test, which adds lib/ to the import path itself. Loading it would
+# otherwise leave a compiled cache-storm-datac next to it.
+dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, True
+try:
+    cache_storm_data = imp.load_source(
+        'cache_storm_data', path.join(path.dirname(path.realpath(__file__)), '../../scripts/cache-storm-data'))
+finally:
+    sys.dont_write_bytecode = dont_write_bytecode
+import storm_utils
+
+# test
+import unittest
+
+
+def topology_summary(name, uptime='1h 0m 0s', version=1):
+    return {'id': '%s_v%d-1-1464117779' % (name, version), 'name': '%s_v%d' % (name, version), 'status': 'ACTIVE', 'uptime': uptime}
+
+
+class StopDaemon(Exception):
+    pass
+
+
+def stop_sleeping(after, sleeps):
+    """
+    A stand-in for time.sleep that keeps how long the test's thread was to sleep in
+    `sleeps`, raising StopDaemon on the `after`th time. The pools' threads sleep as usual.
+    """
+    sleep = time.sleep
+    thread = threading.current_thread()
+
+    def stand_in(seconds):
+        if threading.current_thread() is not thread:
+            return sleep(seconds)
+        sleeps.append(seconds)
+        if len(sleeps) == after:
+            raise StopDaemon()
+    return stand_in
+
+
+class FakeStormUI(object):
+    """
+    Answers the storm UI's REST API for some topologies, each with a spout and a bolt,
+    taking `delay` seconds over each request. Requests for paths in `failing` fail.
+    Keeps every path requested, and the most requests it was answering at once.
+    """
+
+    def __init__(self, topologies, delay=0):
+        self.topologies = topologies
+        self.delay = delay
+        self.failing = set()
+        self.responses = {}
+        self.requests = []
+        self.sessions = []
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def respond(self, url):
+        path = urlparse.urlparse(url).path
+        with self.lock:
+            self.requests.append(path)
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if path in self.failing:
+                raise IOError("Can't reach %s" % url)
+            return self.response(path)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def response(self, path):
+        if path in self.responses:
+            return self.responses[path]
+        if path == '/api/v1/cluster/summary':
+            return {'supervisors': 1}
+        if path == '/api/v1/supervisor/summary':
+            return {'supervisors': []}
+        if path == '/api/v1/topology/summary':
+            return {'topologies': self.topologies}
+
+        parts = path.split('/')
+        topology = parts[4]
+        if len(parts) == 5:
+            return {
+                'id': topology,
+                'spouts': [{'spoutId': 'spout', 'encodedSpoutId': 'spout'}],
+                'bolts': [{'boltId': 'bolt', 'encodedBoltId': 'bolt'}],
+            }
+        return {'id': parts[6], 'topology': topology, 'executorStats': []}
+
+    def session(self):
+        session = FakeSession(self)
+        self.sessions.append(session)
+        return session
+
+
+class FakeSession(object):
+    """Stands in for requests.Session, getting its responses from a FakeStormUI"""
+
+    def __init__(self, ui):
+        self.ui = ui
+        self.adapters = {}
+        self.closed = False
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def get(self, url, timeout=None):
+        return FakeResponse(self.ui.respond(url))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class TestCacheStormData(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_cache(self, ui, *instances):
+        """Returns a StormCache for `instances` (with a cache file each, by default), talking to `ui`"""
+        patcher = patch.object(cache_storm_data.requests, 'Session', side_effect=ui.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cache_storm_data.StormCache(self.write_config(*instances))
+
+    def write_config(self, *instances):
+        for number, instance in enumerate(instances):
+            instance.setdefault('url', 'http://storm-ui:8080')
+            instance.setdefault('topologies', '^(.*)_v\\d+$')
+            instance.setdefault('executor_details_whitelist', ['bolt'])
+            instance.setdefault('cache_file', path.join(self.directory, 'cache-%d.json' % number))
+
+        conf_file = path.join(self.directory, 'storm_rest_api.yaml')
+        mtime = path.getmtime(conf_file) if path.exists(conf_file) else 0
+        with open(conf_file, 'w') as fh:
+            yaml.dump({'init_config': {}, 'instances': list(instances)}, fh)
+        # the config's changed, even if that's within a second of writing it last
+        os.utime(conf_file, (mtime + 1, mtime + 1))
+        return conf_file
+
+    def read_cache(self, cache_file):
+        return storm_utils.CacheReader(cache_file).read()
+
+    def test_fetch(self):
+        names = ['one', 'two', 'three', 'four', 'five']
+        ui = FakeStormUI([topology_summary(name) for name in names], delay=0.05)
+        cache = self.make_cache(ui, {'concurrency': 4})
+        start = time.time()
+        cache.run()
+        duration = time.time() - start
+
+        cached = self.read_cache(cache.instances[0]['cache_file'])
+        self.assertEqual('success', cached['status'])
+        details = dict((topology['name'], topology) for topology in cached['data']['topology_details'])
+        self.assertEqual(sorted(names), sorted(details))
+        for name, topology in details.iteritems():
+            self.assertEqual('success', topology['status'])
+            self.assertEqual('%s_v1-1-1464117779' % name, topology['topology']['id'])
+            # only the whitelisted component's details
+            self.assertEqual(['bolt'], [component['id'] for component in topology['component_details']])
+            self.assertEqual('bolt', topology['component_details'][0]['details']['id'])
+
+        # 3 summaries, and 2 requests for each topology, up to 4 at a time: each topology's
+        # component is fetched alongside the other topologies rather than after all of them
+        self.assertEqual(3 + 5 * 2, len(ui.requests))
+        self.assertEqual(4, ui.most_active)
+        self.assertTrue(duration < 8 * 0.05, "took %.2fs" % duration)
+        self.assertEqual(sorted(ui.requests), sorted(urlparse.urlparse(url).path for url in cached['timings']))
+
+    def test_fetch_concurrency(self):
+        ui = FakeStormUI([topology_summary('topology%d' % number) for number in range(10)], delay=0.01)
+        self.make_cache(ui, {'concurrency': 2}).run()
+        self.assertEqual(2, ui.most_active)
+        self.assertEqual(3 + 10 * 2, len(ui.requests))
+
+    def test_fetch_failures(self):
+        ui = FakeStormUI([topology_summary('one'), topology_summary('two')])
+        ui.failing.add('/api/v1/topology/two_v1-1-1464117779')
+        cache = self.make_cache(ui, {})
+        cache.run()
+
+        # a topology that can't be fetched doesn't hold up the rest
+        cached = self.read_cache(cache.instances[0]['cache_file'])
+        details = dict((topology['name'], topology) for topology in cached['data']['topology_details'])
+        self.assertEqual('success', details['one']['status'])
+        self.assertEqual('error', details['two']['status'])
+        self.assertTrue(details['two']['error_url'].endswith('/api/v1/topology/two_v1-1-1464117779'))
+
+        # but without the list of topologies, there's nothing to cache
+        ui.failing.add('/api/v1/topology/summary')
+        cache.run()
+        cached = self.read_cache(cache.instances[0]['cache_file'])
+        self.assertEqual('error', cached['status'])
+        self.assertTrue(cached['error_url'].endswith('/api/v1/topology/summary'))
+
+    def test_shared_ui_concurrency(self):
+        ui = FakeStormUI([topology_summary('topology%d' % number) for number in range(10)], delay=0.01)
+        cache = self.make_cache(ui, {'concurrency': 2}, {'concurrency': 3})
+        cache.run()
+
+        # both instances fetched from the UI they share, up to the larger of their limits at once
+        self.assertEqual(2 * (3 + 10 * 2), len(ui.requests))
+        self.assertEqual(3, ui.most_active)
+        self.assertEqual(1, len(ui.sessions))
+        self.assertEqual(3, ui.sessions[0].adapters['http://'].poolmanager.connection_pool_kw['maxsize'])
+
+    def test_sessions(self):
+        ui = FakeStormUI([topology_summary('one')])
+        cache = self.make_cache(ui, {'concurrency': 2})
+        cache.run()
+        cache.load_config()
+        cache.run()
+        # the session's kept between runs
+        self.assertEqual(1, len(ui.sessions))
+        self.assertFalse(ui.sessions[0].closed)
+
+        # and closed once its UI's limit changes
+        self.write_config({'concurrency': 3})
+        cache.load_config()
+        cache.run()
+        self.assertEqual(2, len(ui.sessions))
+        self.assertTrue(ui.sessions[0].closed)
+        self.assertFalse(ui.sessions[1].closed)
+
+        # or the UI's no longer used
+        self.write_config({'url': 'http://other-ui:8080', 'concurrency': 3})
+        cache.load_config()
+        cache.run()
+        self.assertEqual(3, len(ui.sessions))
+        self.assertTrue(ui.sessions[1].closed)
+
+    def test_carry_over(self):
+        ui = FakeStormUI([topology_summary('one'), topology_summary('two'), topology_summary('three')])
+        cache = self.make_cache(ui, {'executor_details_whitelist': ['spout', 'bolt']})
+        cache.run()
+        first = self.read_cache(cache.instances[0]['cache_file'])
+        first_details = dict((topology['name'], topology) for topology in first['data']['topology_details'])
+
+        # one topology can't be fetched, another's bolt can't, and the third's been redeployed
+        ui.failing.add('/api/v1/topology/one_v1-1-1464117779')
+        ui.failing.add('/api/v1/topology/two_v1-1-1464117779/component/bolt')
+        ui.topologies[2] = topology_summary('three', uptime='5m 0s', version=2)
+        ui.failing.add('/api/v1/topology/three_v2-1-1464117779')
+        ui.responses['/api/v1/topology/two_v1-1-1464117779/component/spout'] = {'id': 'spout', 'refreshed': True}
+        cache.run()
+        second = self.read_cache(cache.instances[0]['cache_file'])
+        details = dict((topology['name'], topology) for topology in second['data']['topology_details'])
+
+        # what was last fetched is kept, and marked as an error
+        self.assertEqual('error', details['one']['status'])
+        self.assertTrue(details['one']['error_url'].endswith('/api/v1/topology/one_v1-1-1464117779'))
+        self.assertEqual(first_details['one']['updated'], details['one']['updated'])
+        self.assertEqual(first_details['one']['topology'], details['one']['topology'])
+        self.assertEqual(first_details['one']['component_details'], details['one']['component_details'])
+
+        # down to each component
+        self.assertEqual('success', details['two']['status'])
+        self.assertTrue(details['two']['updated'] > first_details['two']['updated'])
+        spout, bolt = details['two']['component_details']
+        self.assertEqual(('spout', 'success', {'id': 'spout', 'refreshed': True}), (spout['id'], spout['status'], spout['details']))
+        self.assertTrue(spout['updated'] > first_details['two']['component_details'][0]['updated'])
+        first_bolt = first_details['two']['component_details'][1]
+        self.assertEqual(('bolt', 'error'), (bolt['id'], bolt['status']))
+        self.assertEqual((first_bolt['updated'], first_bolt['details']), (bolt['updated'], bolt['details']))
+
+        # but not from an earlier deployment
+        self.assertEqual('error', details['three']['status'])
+        self.assertEqual('three_v2-1-1464117779', details['three']['topology_id'])
+        self.assertEqual(0, details['three']['updated'])
+        self.assertEqual([], details['three']['component_details'])
+        self.assertFalse('topology' in details['three'])
+
+    def test_topology_refresh_seconds(self):
+        ui = FakeStormUI([topology_summary('one'), topology_summary('two')])
+        cache = self.make_cache(ui, {'topology_refresh_seconds': {'one': 3600}})
+        cache.run()
+        first = self.read_cache(cache.instances[0]['cache_file'])
+        cache.run()
+        second = self.read_cache(cache.instances[0]['cache_file'])
+
+        # `one` was carried over as it was, and `two` fetched again
+        self.assertEqual(1, ui.requests.count('/api/v1/topology/one_v1-1-1464117779'))
+        self.assertEqual(2, ui.requests.count('/api/v1/topology/two_v1-1-1464117779'))
+        first_details = dict((topology['name'], topology) for topology in first['data']['topology_details'])
+        details = dict((topology['name'], topology) for topology in second['data']['topology_details'])
+        self.assertEqual(first_details['one'], details['one'])
+        self.assertTrue(details['two']['updated'] > first_details['two']['updated'])
+
+        # unless it's been redeployed since
+        ui.topologies[0] = topology_summary('one', version=2)
+        cache.run()
+        self.assertEqual(1, ui.requests.count('/api/v1/topology/one_v2-1-1464117779'))
+
+        # or it's a number for all of them
+        ui = FakeStormUI([topology_summary('one'), topology_summary('two')])
+        cache = self.make_cache(ui, {'topology_refresh_seconds': 3600, 'cache_file': path.join(self.directory, 'all.json')})
+        cache.run()
+        cache.run()
+        self.assertEqual(1, ui.requests.count('/api/v1/topology/one_v1-1-1464117779'))
+        self.assertEqual(1, ui.requests.count('/api/v1/topology/two_v1-1-1464117779'))
+        self.assertEqual(2, ui.requests.count('/api/v1/topology/summary'))
+
+    def test_run_forever(self):
+        ui = FakeStormUI([topology_summary('one')])
+        cache = self.make_cache(ui, {})
+        first_cache, second_cache = [path.join(self.directory, 'cache-%d.json' % number) for number in (0, 1)]
+
+        sleeps = []
+        stop = stop_sleeping(3, sleeps)
+        def sleep(seconds):
+            if threading.current_thread() is not main_thread:
+                return stop(seconds)
+            if len(sleeps) == 0:
+                # the config's re-read once it changes
+                self.assertTrue(path.exists(first_cache))
+                self.assertFalse(path.exists(second_cache))
+                self.write_config({}, {})
+            elif len(sleeps) == 1:
+                # and failures are logged, and tried again next time
+                self.assertTrue(path.exists(second_cache))
+                os.remove(cache.conf_file)
+            stop(seconds)
+
+        main_thread = threading.current_thread()
+        with patch.object(cache_storm_data.time, 'sleep', side_effect=sleep), \
+                patch.object(cache_storm_data.traceback, 'print_exc') as print_exc:
+            self.assertRaises(StopDaemon, cache.run_forever, 30)
+
+        self.assertEqual(3, len(sleeps))
+        self.assertTrue(all(0 < seconds <= 30 for seconds in sleeps), sleeps)
+        self.assertEqual(1, print_exc.call_count)
+        # one instance, then two, then none for want of a config
+        self.assertEqual(3, ui.requests.count('/api/v1/topology/summary'))
+
+    def test_daemon(self):
+        ui = FakeStormUI([topology_summary('one')])
+        conf_file = self.write_config({})
+        script = cache_storm_data.__file__
+
+        sleeps = []
+        with patch.object(sys, 'argv', [script, '--daemon', '--interval', '30', conf_file]), \
+                patch('requests.Session', side_effect=ui.session), \
+                patch('time.sleep', side_effect=stop_sleeping(2, sleeps)):
+            self.assertRaises(StopDaemon, runpy.run_path, script, run_name='__main__')
+
+        self.assertEqual(2, len(sleeps))
+        self.assertTrue(all(0 < seconds <= 30 for seconds in sleeps), sleeps)
+        self.assertEqual(2, ui.requests.count('/api/v1/topology/summary'))
+        # connections are kept open between refreshes
+        self.assertEqual(1, len(ui.sessions))
+        cached = self.read_cache(path.join(self.directory, 'cache-0.json'))
+        self.assertEqual(['one'], [topology['name'] for topology in cached['data']['topology_details']])
+
+    def test_lines_cache(self):
+        ui = FakeStormUI([topology_summary('one'), topology_summary('two')])
+        instance = {'cache_format': 'lines', 'topology_refresh_seconds': {'one': 3600}}
+        self.make_cache(ui, instance).run()
+        first = self.read_cache(instance['cache_file'])
+        self.assertEqual('lines', first['format'])
+
+        # the next run from cron carries over what was cached, in either format
+        ui.failing.add('/api/v1/topology/two_v1-1-1464117779')
+        cache = self.make_cache(ui, instance)
+        cache.run()
+        second = self.read_cache(instance['cache_file'])
+        self.assertEqual(1, ui.requests.count('/api/v1/topology/one_v1-1-1464117779'))
+        first_details = dict((topology['name'], topology) for topology in first['data']['topology_details'])
+        details = dict((topology['name'], topology) for topology in second['data']['topology_details'])
+        self.assertEqual(first_details['one'], details['one'])
+        self.assertEqual('error', details['two']['status'])
+        self.assertEqual(first_details['two']['updated'], details['two']['updated'])
+        self.assertEqual(first_details['two']['topology'], details['two']['topology'])
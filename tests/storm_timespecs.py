@@ -0,0 +1,19 @@
+import re
+
+
+def split_timespec(string):
+    """How translate_timespec used to parse timespecs, a component at a time"""
+    units = {'w': 60*60*24*7, 'd': 60*60*24, 'h': 60*60, 'm': 60, 's': 1}
+    res = 0
+    for component in string.split(' '):
+        if component == '':
+            continue
+        match = re.match('^(\d+)([a-z])$', component)
+        if match is None:
+            raise ValueError("Can't parse the timespec", string, 'component=', component)
+        res += units[match.group(2)] * int(match.group(1))
+    return res
+
+def random_timespec(rng):
+    """A timespec like storm's, with some of its units"""
+    return ' '.join('%d%s' % (rng.randint(0, 59), unit) for unit in 'wdhms' if rng.random() < 0.6)